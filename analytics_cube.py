@@ -0,0 +1,116 @@
+from db_manager import DBManager
+from utils import get_db_name
+
+import logging
+import os
+import pathlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+CUBE_COLLECTION = 'bioinfo_analytics_cube'
+CUBE_FILE = pathlib.Path(__file__).parents[0].joinpath('data', 'analytics_cube.parquet')
+
+# Dimensions and measures of the cube, each document of the
+# collection has one value of every dimension and the measures
+CUBE_DIMENSIONS = ['year', 'source', 'edamCategory', 'position', 'gender']
+CUBE_MEASURES = ['authorships', 'citations']
+
+CUBE_SCHEMA = pa.schema([
+    ('year', pa.int32()),
+    ('source', pa.string()),
+    ('edamCategory', pa.string()),
+    ('position', pa.string()),
+    ('gender', pa.string()),
+    ('authorships', pa.int64()),
+    ('citations', pa.int64())
+])
+
+
+def __get_cube_pipeline():
+    project_paper = {
+        'year': {'$convert': {'input': '$year', 'to': 'int', 'onError': None, 'onNull': None}},
+        'source': 1,
+        'edamCategory': 1,
+        'citations': {'$convert': {'input': '$citations', 'to': 'int', 'onError': 0, 'onNull': 0}},
+        'authors_gender': 1,
+        'authors_id': 1,
+        'num_authors': {'$size': '$authors_gender'}
+    }
+    position = {
+        '$switch': {
+            'branches': [
+                {'case': {'$eq': ['$num_authors', 1]}, 'then': 'single'},
+                {'case': {'$eq': ['$author_index', 0]}, 'then': 'first'},
+                {'case': {'$eq': ['$author_index', {'$subtract': ['$num_authors', 1]}]}, 'then': 'last'}
+            ],
+            'default': 'middle'
+        }
+    }
+    # Vague genders are counted as the gender they point to
+    gender = {
+        '$switch': {
+            'branches': [
+                {'case': {'$in': ['$authors_gender', ['female', 'mostly_female']]}, 'then': 'female'},
+                {'case': {'$in': ['$authors_gender', ['male', 'mostly_male']]}, 'then': 'male'}
+            ],
+            'default': 'unknown'
+        }
+    }
+    group = {
+        '_id': {
+            'year': '$year',
+            'source': '$source',
+            'edamCategory': '$edamCategory',
+            'position': position,
+            'gender': gender
+        },
+        'authorships': {'$sum': 1},
+        'citations': {'$sum': '$citations'}
+    }
+    project_cell = dict({'_id': 0}, **{dimension: f"$_id.{dimension}" for dimension in CUBE_DIMENSIONS},
+                        **{measure: 1 for measure in CUBE_MEASURES})
+    return [
+        {'$match': {'authors_gender.0': {'$exists': True}}},
+        {'$project': project_paper},
+        {'$unwind': {'path': '$authors_gender', 'includeArrayIndex': 'author_index'}},
+        {'$addFields': {'author_id': {'$arrayElemAt': ['$authors_id', '$author_index']}}},
+        # skip authors without name, as the export of authorships does
+        {'$match': {'author_id': {'$ne': '[No author name available]'}}},
+        {'$group': group},
+        {'$project': project_cell},
+        {'$out': CUBE_COLLECTION}
+    ]
+
+
+def build_analytics_cube(file_name=CUBE_FILE):
+    """
+    Materialize the number of authorships and the sum of citations of papers by
+    year, source, EDAM category, position of the author (first, middle, last, or
+    single), and gender of the author. The cube is computed in the database,
+    stored in the collection bioinfo_analytics_cube, and written to a Parquet file.
+    Slices of the cube can be read with DBManager.get_cube_slice
+    """
+    db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
+    db_cube = DBManager(CUBE_COLLECTION, db_name=get_db_name())
+    logging.info('Building the analytics cube...')
+    db_papers.aggregate(__get_cube_pipeline())
+    cells = db_cube.search({}, {'_id': 0})
+    columns = {field.name: [] for field in CUBE_SCHEMA}
+    for cell in cells:
+        for column_name, values in columns.items():
+            values.append(cell.get(column_name))
+    table = pa.Table.from_pydict(columns, schema=CUBE_SCHEMA)
+    tmp_file_name = pathlib.Path(file_name).with_name(f"{pathlib.Path(file_name).name}.tmp")
+    pq.write_table(table, str(tmp_file_name))
+    os.replace(str(tmp_file_name), str(file_name))
+    logging.info(f"The analytics cube has {table.num_rows} cells, saved in {file_name}")
+    return table.num_rows
+
+
+def read_analytics_cube(file_name=CUBE_FILE):
+    # Read the cube from its Parquet file, as a data frame
+    return pq.read_table(str(file_name)).to_pandas()
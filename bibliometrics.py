@@ -0,0 +1,113 @@
+import logging
+import numpy as np
+import pathlib
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+###
+# Citations of a set of authors flattened into arrays. Within each
+# author, citations are sorted in descending order so that metrics
+# can be computed for all the authors at once
+###
+class AuthorCitations:
+
+    def __init__(self, citations_by_author):
+        """
+        :param citations_by_author: list with the list of citations of each author,
+        values that are not numbers (e.g., '' for papers without citations) count as 0
+        """
+        self.num_authors = len(citations_by_author)
+        self.counts = np.array([len(citations) for citations in citations_by_author], dtype=np.int64)
+        self.starts = np.zeros(self.num_authors, dtype=np.int64)
+        if self.num_authors > 0:
+            self.starts[1:] = np.cumsum(self.counts)[:-1]
+        citations = np.array([_to_number(citation) for citations in citations_by_author for citation in citations],
+                             dtype=np.int64)
+        authors = np.repeat(np.arange(self.num_authors), self.counts)
+        # Sort by author and, within the author, by citations in descending order
+        order = np.lexsort((-citations, authors))
+        self.citations = citations[order]
+        self.authors = authors[order]
+        # Position (starting from 1) of each paper in the ranking of its author
+        self.ranks = np.arange(len(self.citations)) - self.starts[self.authors] + 1
+
+    def sum_by_author(self, values):
+        return np.bincount(self.authors, weights=values, minlength=self.num_authors)
+
+    def cumsum_by_author(self, values):
+        cumsum = np.concatenate(([0], np.cumsum(values)))
+        # Sum of the values of the previous authors
+        offsets = cumsum[self.starts]
+        return cumsum[1:] - offsets[self.authors]
+
+    def max_by_author(self, values):
+        result = np.zeros(self.num_authors, dtype=np.int64)
+        np.maximum.at(result, self.authors, values)
+        return result
+
+
+def _to_number(citation):
+    try:
+        return int(citation)
+    except (TypeError, ValueError):
+        return 0
+
+
+def compute_h_index(author_citations):
+    # Since citations are sorted in descending order, the papers
+    # with at least as many citations as its rank are the first h
+    return author_citations.sum_by_author(author_citations.citations >= author_citations.ranks).astype(np.int64)
+
+
+def compute_g_index(author_citations):
+    # Largest rank g whose top g papers received together at least g^2 citations
+    cumulative_citations = author_citations.cumsum_by_author(author_citations.citations)
+    ranks = author_citations.ranks
+    return author_citations.max_by_author(np.where(cumulative_citations >= ranks ** 2, ranks, 0))
+
+
+def compute_i10_index(author_citations):
+    return author_citations.sum_by_author(author_citations.citations >= 10).astype(np.int64)
+
+
+def compute_mean_citations(author_citations):
+    totals = author_citations.sum_by_author(author_citations.citations)
+    return np.divide(totals, author_citations.counts, out=np.zeros(author_citations.num_authors),
+                     where=author_citations.counts > 0)
+
+
+def compute_median_citations(author_citations):
+    medians = np.zeros(author_citations.num_authors)
+    with_papers = author_citations.counts > 0
+    starts, counts = author_citations.starts[with_papers], author_citations.counts[with_papers]
+    # Citations of each author are contiguous and sorted, so the median is in the middle of its segment
+    lower = author_citations.citations[starts + (counts - 1) // 2]
+    upper = author_citations.citations[starts + counts // 2]
+    medians[with_papers] = (lower + upper) / 2
+    return medians
+
+
+# Metrics computed by compute_bibliometrics, by the name of the field where
+# they are stored. New metrics only need a function that takes an
+# AuthorCitations and returns an array with the value of each author
+METRICS = {
+    'h-index': compute_h_index,
+    'g-index': compute_g_index,
+    'i10-index': compute_i10_index,
+    'mean_citations': compute_mean_citations,
+    'median_citations': compute_median_citations
+}
+
+
+def compute_bibliometrics(citations_by_author, metrics=None):
+    """
+    Compute the bibliometric indicators of several authors at once
+    :param citations_by_author: list with the list of citations of each author
+    :param metrics: names of the metrics to compute, all in METRICS if None
+    :return: dictionary with an array of values, one per author, for each metric
+    """
+    author_citations = AuthorCitations(citations_by_author)
+    metric_names = metrics or list(METRICS.keys())
+    return {metric_name: METRICS[metric_name](author_citations) for metric_name in metric_names}
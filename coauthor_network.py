@@ -0,0 +1,195 @@
+from data_exporter import load_author_papers
+from db_manager import DBManager
+from scipy import sparse
+from utils import get_db_name
+
+import logging
+import numpy as np
+import pandas as pd
+import pathlib
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+GENDERS = ['female', 'male']
+
+# Vague genders returned by the gender identification services
+GENDER_MAPPING = {
+    'mostly_female': 'female',
+    'mostly_male': 'male'
+}
+
+
+def __normalize_genders(papers_authors):
+    papers_authors['author_gender'] = papers_authors['author_gender'].replace(GENDER_MAPPING)
+    return papers_authors
+
+
+def load_papers_authors(file_name=None):
+    """
+    Load the authorships exported by export_author_papers
+    :param file_name: path of the CSV, Parquet, or Feather export, data/papers_authors.csv by default
+    :return: data frame with the columns id (paper), year, author_id, and author_gender
+    """
+    if not file_name:
+        file_name = pathlib.Path(__file__).parents[0].joinpath('data', 'papers_authors.csv')
+    columns = ['id', 'year', 'author_id', 'author_gender']
+    if pathlib.Path(file_name).suffix == '.csv':
+        papers_authors = pd.read_csv(str(file_name), usecols=columns,
+                                     dtype={'id': str, 'author_id': str, 'author_gender': str})
+    else:
+        papers_authors = load_author_papers(file_name, columns=columns)
+        papers_authors['author_gender'] = papers_authors['author_gender'].astype(str)
+    return __normalize_genders(papers_authors)
+
+
+def load_papers_authors_from_db(db_name=''):
+    """
+    Load the authorships from the collection bioinfo_papers
+    :return: data frame with the columns id (paper), year, author_id, and author_gender
+    """
+    db_papers = DBManager('bioinfo_papers', db_name=db_name or get_db_name())
+    papers = db_papers.search({'authors_id.0': {'$exists': True}},
+                              {'e_id': 1, 'year': 1, 'authors_id': 1, 'authors_gender': 1}, stream=True)
+    rows = {'id': [], 'year': [], 'author_id': [], 'author_gender': []}
+    for paper in papers:
+        authors_gender = paper.get('authors_gender') or []
+        for idx, author_id in enumerate(paper['authors_id']):
+            if author_id == '[No author name available]':
+                continue
+            rows['id'].append(paper['e_id'])
+            rows['year'].append(paper.get('year'))
+            rows['author_id'].append(author_id)
+            rows['author_gender'].append(authors_gender[idx] if idx < len(authors_gender) else '')
+    papers_authors = pd.DataFrame(rows)
+    papers_authors['year'] = pd.to_numeric(papers_authors['year'], errors='coerce')
+    return __normalize_genders(papers_authors)
+
+
+###
+# Incidence matrix between papers (rows) and authors (columns), stored
+# as a sparse CSR matrix where a one indicates an authorship
+###
+class PaperAuthorMatrix:
+
+    def __init__(self, papers_authors):
+        """
+        :param papers_authors: data frame with the columns id (paper) and author_id
+        """
+        paper_codes, self.paper_ids = pd.factorize(papers_authors['id'])
+        author_codes, self.author_ids = pd.factorize(papers_authors['author_id'])
+        self.matrix = sparse.csr_matrix((np.ones(len(paper_codes), dtype=np.int32), (paper_codes, author_codes)),
+                                        shape=(len(self.paper_ids), len(self.author_ids)))
+        # Duplicated authorships are summed up when the matrix is built
+        self.matrix.data[:] = 1
+
+    @property
+    def num_papers(self):
+        return self.matrix.shape[0]
+
+    @property
+    def num_authors(self):
+        return self.matrix.shape[1]
+
+    def get_coauthorship_matrix(self):
+        """
+        :return: sparse authors x authors matrix with a one between authors who
+        share at least one paper, the diagonal is empty
+        """
+        coauthorship = (self.matrix.T @ self.matrix).tocsr()
+        coauthorship.setdiag(0)
+        coauthorship.eliminate_zeros()
+        coauthorship.data[:] = 1
+        return coauthorship
+
+    def get_author_indicators(self, author_values, values):
+        """
+        :param author_values: series with a value by author id
+        :param values: values to encode
+        :return: sparse authors x values matrix with a one in the column of the value of each author
+        """
+        author_values = author_values.reindex(self.author_ids)
+        indicators = [(author_values == value).values.astype(np.int32) for value in values]
+        return sparse.csr_matrix(np.column_stack(indicators))
+
+
+def get_author_genders(papers_authors):
+    # The gender of an author is the one of its first authorship
+    return papers_authors.drop_duplicates(subset=['author_id']).set_index('author_id')['author_gender']
+
+
+def compute_coauthors_gender_distribution(papers_authors, paper_author_matrix=None):
+    """
+    Count the unique co-authors of every author by gender
+    :param papers_authors: data frame with the columns id (paper), author_id, and author_gender
+    :param paper_author_matrix: PaperAuthorMatrix of papers_authors, built if not given
+    :return: data frame with the columns id (author), num_male_coauthors, num_female_coauthors,
+    ratio_female_male, prop_female, prop_male, and total_coauthors
+    """
+    if paper_author_matrix is None:
+        paper_author_matrix = PaperAuthorMatrix(papers_authors)
+    coauthorship = paper_author_matrix.get_coauthorship_matrix()
+    gender_indicators = paper_author_matrix.get_author_indicators(get_author_genders(papers_authors), GENDERS)
+    coauthors_by_gender = np.asarray((coauthorship @ gender_indicators).todense())
+    num_females, num_males = coauthors_by_gender[:, 0], coauthors_by_gender[:, 1]
+    total_coauthors = num_females + num_males
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio_female_male = np.where(num_males > 0, num_females / num_males, 0)
+        prop_female = num_females / total_coauthors
+    coauthors_gender_distribution = pd.DataFrame({
+        'id': paper_author_matrix.author_ids,
+        'num_male_coauthors': num_males,
+        'num_female_coauthors': num_females,
+        'ratio_female_male': ratio_female_male,
+        'prop_female': prop_female,
+        'prop_male': 1 - prop_female,
+        'total_coauthors': total_coauthors
+    })
+    logging.info(f"Computed the gender distribution of the co-authors of {paper_author_matrix.num_authors} authors")
+    return coauthors_gender_distribution
+
+
+def compute_evolution_gender_distribution(papers_authors, authors=None, min_num_years=5):
+    """
+    Count, for every author and year, the female and male co-authors of the papers
+    that the author published that year, together with their proportions and the
+    cumulative proportions up to the year
+    :param papers_authors: data frame with the columns id (paper), year, author_id, and author_gender
+    :param authors: optional data frame with the columns id, name, gender, and papers of authors,
+    which are added to the result
+    :param min_num_years: authors with female or male co-authors in fewer years are discarded
+    :return: tidy data frame with one row per author and year
+    """
+    authorships = papers_authors[['id', 'year', 'author_id', 'author_gender']]
+    authorships = authorships.drop_duplicates(subset=['id', 'author_id']).copy()
+    for gender in GENDERS:
+        authorships[gender] = (authorships['author_gender'] == gender).astype(np.int64)
+    # Authors of each paper by gender, the author is then subtracted to get the co-authors
+    paper_authors = authorships.groupby('id')[GENDERS].transform('sum')
+    paper_sizes = authorships.groupby('id')['author_id'].transform('size')
+    coauthorships = pd.DataFrame({
+        'id': authorships['author_id'],
+        'years': authorships['year'],
+        'num_female_coauthors': paper_authors['female'] - authorships['female'],
+        'num_male_coauthors': paper_authors['male'] - authorships['male'],
+        'num_coauthors': paper_sizes - 1
+    })
+    evolution = coauthorships.groupby(['id', 'years'], as_index=False).sum().drop(columns='num_coauthors')
+    evolution['total_coauthors'] = evolution['num_female_coauthors'] + evolution['num_male_coauthors']
+    # Only years with female or male co-authors are considered, in the rest the
+    # proportions are undefined
+    evolution = evolution[evolution['total_coauthors'] > 0]
+    num_years = evolution.groupby('id')['years'].transform('size')
+    evolution = evolution[num_years >= min_num_years].sort_values(['id', 'years']).reset_index(drop=True)
+    evolution['prop_female_coauthors'] = evolution['num_female_coauthors'] / evolution['total_coauthors']
+    evolution['prop_male_coauthors'] = evolution['num_male_coauthors'] / evolution['total_coauthors']
+    cumulative = evolution.groupby('id')[['num_female_coauthors', 'total_coauthors']].cumsum()
+    evolution['cum_prop_female_coauthors'] = cumulative['num_female_coauthors'] / cumulative['total_coauthors']
+    evolution['cum_prop_male_coauthors'] = 1 - evolution['cum_prop_female_coauthors']
+    if authors is not None:
+        author_info = authors[['id', 'name', 'gender', 'papers']].rename(columns={'papers': 'total_papers'})
+        evolution = evolution.merge(author_info, on='id', how='inner')
+    logging.info(f"Computed the evolution of the gender of co-authors of {evolution['id'].nunique()} authors "
+                 f"with female or male co-authors in at least {min_num_years} years")
+    return evolution
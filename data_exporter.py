@@ -1,108 +1,629 @@
 
 import csv
+import datetime
+import json
 import logging
+import multiprocessing
+import os
+import pandas as pd
 import pathlib
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import shutil
 
-from db_manager import DBManager
+from db_manager import DBManager, UPDATED_AT_FIELD
 
 logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
                     level=logging.DEBUG)
 
 
-def export_db_into_file(filename_to_export, db, fields_to_export):
-    records = db.search({})
-    current_dir = pathlib.Path(__file__).parents[0]
-    fn = current_dir.joinpath('data', filename_to_export)
-    logging.info('Exporting data, please wait...')
+DATA_DIR = pathlib.Path(__file__).parents[0].joinpath('data')
+EXPORT_STATE_FILE = DATA_DIR.joinpath('export_state.json')
+DELTAS_DIR = DATA_DIR.joinpath('deltas')
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+GENDERED = {'male', 'female', 'mostly_male', 'mostly_female'}
+
+
+def __count_gendered_authors(record):
+    # Sum up only male or female authors
+    return sum(1 for author_gender in record['authors_gender'] if author_gender in GENDERED)
+
+
+def __get_gender_last_author(record):
+    if len(record['authors_gender']) == 0:
+        return '-'
+    # Return the last gender, which should be male or female
+    for author_gender in reversed(record['authors_gender']):
+        if author_gender == 'male' or author_gender == 'female':
+            return author_gender
+    return None
+
+
+# Fields of the exports that are computed from other fields of the records, by
+# the name of the column: (fields of the record needed, function that computes
+# the value from the record). The value is not exported if the fields are missing
+FIELD_TRANSFORMS = {
+    'countries': (['countries'], lambda record: '-'.join(record['countries'])),
+    'authors': (['authors_gender'], __count_gendered_authors),
+    'gender_last_author': (['authors_gender'], __get_gender_last_author)
+}
+
+
+def __copy_field(field):
+    return [field], lambda record: record[field]
+
+
+def __compile_fields(fields_to_export):
+    """
+    :return: tuple (projection with only the fields needed by the export, list of
+    tuples (column, fields of the record needed, function that computes the value))
+    """
+    projection = {'_id': 0, 'e_id': 1, 'id': 1}
+    field_transforms = []
+    for field in fields_to_export:
+        source_fields, transform = FIELD_TRANSFORMS.get(field) or __copy_field(field)
+        projection.update({source_field: 1 for source_field in source_fields})
+        field_transforms.append((field, source_fields, transform))
+    return projection, field_transforms
+
+
+def __record_to_row(record, field_transforms):
+    if 'e_id' in record:
+        record_id = record['e_id']
+    else:
+        if record.get('id') == '[No author name available]':
+            # skip authors without name
+            return None
+        record_id = record.get('id')
+    record_to_save = {'id': record_id}
+    for field, source_fields, transform in field_transforms:
+        if all(source_field in record for source_field in source_fields):
+            record_to_save[field] = transform(record)
+    return record_to_save
+
+
+def __write_records(fn, records, fields_to_export, field_transforms, write_header=True):
     with open(str(fn), 'w', encoding='utf-8') as f:
         headers = ['id']
         headers.extend(fields_to_export)
         writer = csv.DictWriter(f, fieldnames=headers)
-        writer.writeheader()
+        if write_header:
+            writer.writeheader()
         record_counter = 0
         for record in records:
             record_counter += 1
-            record_to_save = dict()
-            if 'e_id' in record:
-                record_id = record['e_id']
-            else:
-                if record['id'] == '[No author name available]':
-                    # skip authors without name
-                    continue
-                record_id = record['id']
-            for key, value in record.items():
-                if key in fields_to_export:
-                    if key == 'countries':
-                        countries = '-'.join(value)
-                        record_to_save[key] = countries
-                    elif key == 'authors':
-                        num_authors = 0
-                        # Sum up only male or female authors
-                        for idx in range(0, len(value)):
-                            if record['authors_gender'][idx] == 'male' or \
-                               record['authors_gender'][idx] == 'female' or \
-                               record['authors_gender'][idx] == 'mostly_male' or \
-                               record['authors_gender'][idx] == 'mostly_female':
-                                num_authors += 1
-                        record_to_save[key] = num_authors
-                    else:
-                        record_to_save[key] = value
-                else:
-                    if key == 'authors_gender':
-                        if 'gender_last_author' in fields_to_export:
-                            if len(record['authors_gender']) > 0:
-                                # Return the last gender, which should be male or female
-                                record['authors_gender'].reverse()
-                                for author_gender in record['authors_gender']:
-                                    if author_gender == 'male' or author_gender == 'female':
-                                        record_to_save['gender_last_author'] = author_gender
-                                        break
-                            else:
-                                record_to_save['gender_last_author'] = '-'
-            record_to_save['id'] = record_id
-            writer.writerow(record_to_save)
+            record_to_save = __record_to_row(record, field_transforms)
+            if record_to_save:
+                writer.writerow(record_to_save)
+    return record_counter
+
+
+def export_db_into_file(filename_to_export, db, fields_to_export):
+    # Only the fields needed by the export are read from the database
+    projection, field_transforms = __compile_fields(fields_to_export)
+    records = db.search({}, projection, stream=True)
+    current_dir = pathlib.Path(__file__).parents[0]
+    fn = current_dir.joinpath('data', filename_to_export)
+    logging.info('Exporting data, please wait...')
+    record_counter = __write_records(fn, records, fields_to_export, field_transforms)
     logging.info(f"It was exported {record_counter} records")
 
 
-def export_author_papers(filename):
+AUTHOR_PAPERS_HEADERS = ['id', 'title', 'doi', 'year', 'category', 'author_id', 'author', 'author_gender',
+                         'author_position']
+
+# Columns of the columnar export of authorships, those with few distinct
+# values are dictionary encoded and loaded as categoricals by pandas
+AUTHOR_PAPERS_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('title', pa.string()),
+    ('doi', pa.string()),
+    ('year', pa.int16()),
+    ('source', pa.dictionary(pa.int32(), pa.string())),
+    ('category', pa.dictionary(pa.int32(), pa.string())),
+    ('author_id', pa.string()),
+    ('author', pa.string()),
+    ('author_gender', pa.dictionary(pa.int8(), pa.string())),
+    ('author_position', pa.int32())
+])
+
+# Same columns without dictionary encoding, used where batches are written
+# before all the values of the dictionary encoded columns are known
+AUTHOR_PAPERS_PLAIN_SCHEMA = pa.schema([
+    (field.name, field.type.value_type if pa.types.is_dictionary(field.type) else field.type)
+    for field in AUTHOR_PAPERS_SCHEMA
+])
+
+# Number of authorships of the record batches of the columnar exports
+AUTHOR_PAPERS_BATCH_SIZE = 50000
+
+# Partition of the authorships of papers without year, write_to_dataset drops
+# the rows whose partition value is null
+UNKNOWN_YEAR = 0
+
+
+def __get_author_papers_pipeline():
+    project_paper = {
+        '_id': 0,
+        'e_id': 1,
+        'title': 1,
+        'DOI': 1,
+        'year': 1,
+        'source': 1,
+        'edamCategory': 1,
+        'authors': 1,
+        'authors_gender': 1,
+        'authors_id': 1
+    }
+    project_authorship = {
+        'id': '$e_id',
+        'title': '$title',
+        'doi': '$DOI',
+        'year': '$year',
+        'source': '$source',
+        'category': '$edamCategory',
+        'author_id': {'$arrayElemAt': ['$authors_id', '$author_index']},
+        'author': '$authors',
+        'author_gender': {'$arrayElemAt': ['$authors_gender', '$author_index']},
+        'author_position': {'$add': ['$author_index', 1]}
+    }
+    return [
+        {'$match': {'authors.0': {'$exists': True}}},
+        {'$project': project_paper},
+        {'$unwind': {'path': '$authors', 'includeArrayIndex': 'author_index'}},
+        {'$project': project_authorship},
+        # skip authors without name
+        {'$match': {'author_id': {'$ne': '[No author name available]'}}}
+    ]
+
+
+def __iter_author_papers(report, papers_query=None):
+    # Authorships are flattened by the database, one document per author of each paper
     db_papers = DBManager('bioinfo_papers')
-    papers = db_papers.search({})
+    papers_query = papers_query or {}
+    report['papers'] = db_papers.num_records(dict(papers_query, **{'authors.0': {'$exists': True}}))
+    report['papers_without_authors'] = db_papers.num_records(papers_query) - report['papers']
+    pipeline = __get_author_papers_pipeline()
+    if papers_query:
+        pipeline.insert(0, {'$match': papers_query})
+    for author_paper in db_papers.aggregate_stream(pipeline):
+        report['records'] += 1
+        yield author_paper
+
+
+def __to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def __build_author_papers_table(author_papers, dictionary_encode=True, missing_year=None):
+    columns = {field.name: [] for field in AUTHOR_PAPERS_SCHEMA}
+    for author_paper in author_papers:
+        for column_name, values in columns.items():
+            # $project leaves out the fields that papers don't have
+            values.append(author_paper.get(column_name))
+    years = (__to_int(year) for year in columns['year'])
+    columns['year'] = [missing_year if year is None else year for year in years]
+    arrays = []
+    for field in AUTHOR_PAPERS_SCHEMA:
+        if pa.types.is_dictionary(field.type):
+            values = [str(value) if value is not None else None for value in columns[field.name]]
+            values = pa.array(values, type=pa.string())
+            arrays.append(values.dictionary_encode().cast(field.type) if dictionary_encode else values)
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+    schema = AUTHOR_PAPERS_SCHEMA if dictionary_encode else AUTHOR_PAPERS_PLAIN_SCHEMA
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def __iter_author_papers_tables(author_papers, dictionary_encode=True, missing_year=None):
+    # Authorships are converted in batches, so that only a batch is held in memory
+    batch = []
+    for author_paper in author_papers:
+        batch.append(author_paper)
+        if len(batch) >= AUTHOR_PAPERS_BATCH_SIZE:
+            yield __build_author_papers_table(batch, dictionary_encode, missing_year)
+            batch = []
+    if batch:
+        yield __build_author_papers_table(batch, dictionary_encode, missing_year)
+
+
+def __iter_arrow_file_batches(file_names):
+    for file_name in file_names:
+        reader = pa.ipc.open_file(pa.memory_map(str(file_name)))
+        for batch_idx in range(reader.num_record_batches):
+            yield reader.get_batch(batch_idx)
+
+
+def __get_distinct_values(column):
+    if pa.types.is_dictionary(column.type):
+        return column.dictionary.to_pylist()
+    return column.to_pylist()
+
+
+def __encode_batch(batch, dictionaries):
+    arrays = []
+    for field in AUTHOR_PAPERS_SCHEMA:
+        column = batch.column(batch.schema.get_field_index(field.name))
+        if pa.types.is_dictionary(field.type):
+            codes = pd.Categorical(column.to_pylist(), categories=dictionaries[field.name]).codes
+            indices = pa.array(codes.astype('int32'), type=pa.int32(), mask=codes < 0).cast(field.type.index_type)
+            column = pa.DictionaryArray.from_arrays(indices, pa.array(dictionaries[field.name], type=pa.string()))
+        arrays.append(column)
+    return pa.RecordBatch.from_arrays(arrays, names=AUTHOR_PAPERS_SCHEMA.names)
+
+
+def __write_feather_file(fn, file_names):
+    """
+    Write into a Feather file the record batches of Arrow files (Feather files,
+    plain or with their own dictionaries). Feather files need a single dictionary
+    per column, so the dictionaries are collected in a first pass over the batches
+    and the batches are encoded with them in a second one
+    """
+    dictionaries = {field.name: set() for field in AUTHOR_PAPERS_SCHEMA if pa.types.is_dictionary(field.type)}
+    for batch in __iter_arrow_file_batches(file_names):
+        for column_name, values in dictionaries.items():
+            values.update(__get_distinct_values(batch.column(batch.schema.get_field_index(column_name))))
+    dictionaries = {column_name: sorted(values - {None}) for column_name, values in dictionaries.items()}
+    writer = pa.RecordBatchFileWriter(str(fn), AUTHOR_PAPERS_SCHEMA)
+    try:
+        for batch in __iter_arrow_file_batches(file_names):
+            writer.write_batch(__encode_batch(batch, dictionaries))
+    finally:
+        writer.close()
+
+
+def __check_author_papers_format(file_format, partition_by_year):
+    if file_format not in ('csv', 'parquet', 'feather'):
+        raise ValueError(f"Unknown format {file_format}, the options are csv, parquet, and feather")
+    if partition_by_year and file_format != 'parquet':
+        raise ValueError('Only Parquet exports can be partitioned by year')
+
+
+def __write_author_papers(fn, author_papers, file_format, partition_by_year, write_header=True, part=None):
+    if file_format == 'csv':
+        with open(str(fn), 'w', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=AUTHOR_PAPERS_HEADERS, extrasaction='ignore')
+            if write_header:
+                writer.writeheader()
+            writer.writerows(author_papers)
+        return
+    if partition_by_year:
+        tables = __iter_author_papers_tables(author_papers, missing_year=UNKNOWN_YEAR)
+        for batch_idx, table in enumerate(tables):
+            # Every batch writes its own file in the partitions of its years
+            file_name = f"part-{part}-{batch_idx}.parquet" if part is not None else f"part-{batch_idx}.parquet"
+            pq.write_to_dataset(table, str(fn), partition_cols=['year'],
+                                partition_filename_cb=lambda keys: file_name)
+    elif file_format == 'parquet':
+        writer = pq.ParquetWriter(str(fn), AUTHOR_PAPERS_SCHEMA)
+        try:
+            for table in __iter_author_papers_tables(author_papers):
+                writer.write_table(table)
+        finally:
+            writer.close()
+    else:
+        # Batches are written without dictionaries to a temporary file, which
+        # is then encoded with the dictionaries of the whole export
+        tmp_fn = fn.with_name(f".{fn.name}.{os.getpid()}.tmp")
+        writer = pa.RecordBatchFileWriter(str(tmp_fn), AUTHOR_PAPERS_PLAIN_SCHEMA)
+        try:
+            for table in __iter_author_papers_tables(author_papers, dictionary_encode=False):
+                writer.write_table(table)
+        finally:
+            writer.close()
+        __write_feather_file(fn, [tmp_fn])
+        tmp_fn.unlink()
+
+
+def export_author_papers(filename, file_format='csv', partition_by_year=False):
+    """
+    Export the authorships, one row per author of each paper
+    :param file_format: csv, parquet, or feather. Parquet and Feather files store the source,
+    category, and gender as dictionary encoded columns and the year and position as integers
+    :param partition_by_year: only for parquet, write a directory with one partition per year
+    """
+    __check_author_papers_format(file_format, partition_by_year)
     current_dir = pathlib.Path(__file__).parents[0]
     fn = current_dir.joinpath('data', filename)
     logging.info('Exporting data of papers and authors, please wait...')
-    with open(str(fn), 'w', encoding='utf-8') as f:
-        headers = ['id', 'title', 'doi', 'year', 'category', 'author_id', 'author', 'author_gender', 'author_position']
-        writer = csv.DictWriter(f, fieldnames=headers)
+    report = {'records': 0, 'papers': 0, 'papers_without_authors': 0}
+    __write_author_papers(fn, __iter_author_papers(report), file_format, partition_by_year)
+    logging.info(f"It was exported {report['papers']} papers")
+    logging.info(f"Found {report['papers_without_authors']} papers without authors")
+
+
+###
+# Parallel exports. Each export is split into ranges of _id of the exported
+# collection, the shards of all the exports are written concurrently by a
+# pool of processes into part files, which are then merged
+###
+def get_records_export_job(filename_to_export, db, fields_to_export):
+    return {
+        'type': 'records',
+        'filename': filename_to_export,
+        'collection': db.collection_name,
+        'db_name': db.db_name,
+        'fields': fields_to_export,
+        'file_format': 'csv'
+    }
+
+
+def get_author_papers_export_job(filename, file_format='csv', partition_by_year=False):
+    __check_author_papers_format(file_format, partition_by_year)
+    db_papers = DBManager('bioinfo_papers')
+    return {
+        'type': 'author_papers',
+        'filename': filename,
+        'collection': db_papers.collection_name,
+        'db_name': db_papers.db_name,
+        'file_format': file_format,
+        'partition_by_year': partition_by_year
+    }
+
+
+def __get_parts_dir(job):
+    return pathlib.Path(__file__).parents[0].joinpath('data', f".{job['filename']}.parts")
+
+
+def __get_part_path(job, part):
+    if job.get('partition_by_year'):
+        # Shards write their own file in every partition of the dataset
+        return __get_parts_dir(job)
+    return __get_parts_dir(job).joinpath(f"part-{part}.{job['file_format']}")
+
+
+def __export_shard(task):
+    job_idx, job, part, id_range = task
+    part_path = __get_part_path(job, part)
+    if job['type'] == 'records':
+        projection, field_transforms = __compile_fields(job['fields'])
+        records = DBManager(job['collection'], db_name=job['db_name']).search(id_range, projection, stream=True)
+        num_records = __write_records(part_path, records, job['fields'], field_transforms, write_header=False)
+        return job_idx, {'records': num_records}
+    report = {'records': 0, 'papers': 0, 'papers_without_authors': 0}
+    author_papers = __iter_author_papers(report, id_range)
+    __write_author_papers(part_path, author_papers, job['file_format'], job['partition_by_year'],
+                          write_header=False, part=part)
+    return job_idx, report
+
+
+def __merge_parts(job, num_parts):
+    fn = pathlib.Path(__file__).parents[0].joinpath('data', job['filename'])
+    parts_dir = __get_parts_dir(job)
+    if fn.is_dir():
+        shutil.rmtree(str(fn))
+    if job['file_format'] == 'parquet':
+        # The parts already form a dataset, which is loaded as a single table
+        if fn.is_file():
+            fn.unlink()
+        os.replace(str(parts_dir), str(fn))
+        return
+    tmp_fn = fn.with_name(f"{fn.name}.tmp")
+    if job['file_format'] == 'csv':
+        if job['type'] == 'records':
+            headers = ['id'] + job['fields']
+        else:
+            headers = AUTHOR_PAPERS_HEADERS
+        with open(str(tmp_fn), 'w', encoding='utf-8') as f:
+            csv.DictWriter(f, fieldnames=headers).writeheader()
+            for part in range(num_parts):
+                with open(str(__get_part_path(job, part)), 'r', encoding='utf-8') as part_file:
+                    shutil.copyfileobj(part_file, f)
+    else:
+        __write_feather_file(tmp_fn, [__get_part_path(job, part) for part in range(num_parts)])
+    os.replace(str(tmp_fn), str(fn))
+    shutil.rmtree(str(parts_dir))
+
+
+def export_files_in_parallel(export_jobs, num_workers=4, shards_per_worker=2):
+    """
+    Run several exports at the same time. The records of every export are split
+    into ranges of _id that are exported concurrently by a pool of processes
+    :param export_jobs: exports created with get_records_export_job and get_author_papers_export_job.
+    CSV and Feather files are merged into a single file, Parquet exports are written as a dataset
+    (i.e., a directory with one file per shard), which can be loaded with load_author_papers
+    """
+    tasks, num_parts, last_update_times = [], [], []
+    for job_idx, job in enumerate(export_jobs):
+        parts_dir = __get_parts_dir(job)
+        if parts_dir.exists():
+            shutil.rmtree(str(parts_dir))
+        parts_dir.mkdir(parents=True)
+        db = DBManager(job['collection'], db_name=job['db_name'])
+        # Records changed from now on will be in the next incremental export
+        last_update_times.append(db.get_last_update_time())
+        id_ranges = db.get_id_ranges(num_workers * shards_per_worker)
+        num_parts.append(len(id_ranges))
+        tasks.extend((job_idx, job, part, id_range) for part, id_range in enumerate(id_ranges))
+        logging.info(f"Exporting {job['filename']} in {len(id_ranges)} shards...")
+    reports = [dict() for _ in export_jobs]
+    if num_workers > 1:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            shard_reports = list(pool.imap_unordered(__export_shard, tasks))
+    else:
+        shard_reports = [__export_shard(task) for task in tasks]
+    for job_idx, shard_report in shard_reports:
+        for key, value in shard_report.items():
+            reports[job_idx][key] = reports[job_idx].get(key, 0) + value
+    export_state = __load_export_state()
+    for job_idx, job in enumerate(export_jobs):
+        __merge_parts(job, num_parts[job_idx])
+        __remove_deltas(export_state.get(job['filename'], {}))
+        export_state[job['filename']] = {'last_update_time': __format_time(last_update_times[job_idx]), 'deltas': []}
+        logging.info(f"Exported {job['filename']}: {reports[job_idx]}")
+    __save_export_state(export_state)
+    return reports
+
+
+###
+# Incremental exports. After a full export, only the records changed since
+# the previous export (see UPDATED_AT_FIELD in db_manager.py) are exported
+# into delta files, which are merged into the full export by compact_export
+###
+def __load_export_state():
+    if not EXPORT_STATE_FILE.exists():
+        return dict()
+    with open(str(EXPORT_STATE_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def __save_export_state(export_state):
+    tmp_file_name = EXPORT_STATE_FILE.with_name(f"{EXPORT_STATE_FILE.name}.tmp")
+    with open(str(tmp_file_name), 'w', encoding='utf-8') as f:
+        json.dump(export_state, f, indent=2)
+    os.replace(str(tmp_file_name), str(EXPORT_STATE_FILE))
+
+
+def __format_time(update_time):
+    return update_time.strftime(TIME_FORMAT) if update_time else None
+
+
+def __remove_deltas(job_state):
+    for delta_file_name in job_state.get('deltas', []):
+        delta_file = DELTAS_DIR.joinpath(delta_file_name)
+        if delta_file.exists():
+            delta_file.unlink()
+
+
+def export_changes(export_job):
+    """
+    Export into a delta file the records changed since the last export. The
+    export must have been fully exported before and be in CSV format. Records
+    removed from the database are not tracked, they remain in the export
+    :return: name of the delta file, None if there were no changes
+    """
+    if export_job['file_format'] != 'csv':
+        raise ValueError('Only CSV exports can be exported incrementally')
+    export_state = __load_export_state()
+    job_state = export_state.get(export_job['filename'])
+    if not job_state or not job_state.get('last_update_time'):
+        raise ValueError(f"{export_job['filename']} must be fully exported before exporting its changes")
+    db = DBManager(export_job['collection'], db_name=export_job['db_name'])
+    previous_update_time = datetime.datetime.strptime(job_state['last_update_time'], TIME_FORMAT)
+    last_update_time = db.get_last_update_time()
+    # Without any record with update time there is nothing to export
+    if last_update_time is None or last_update_time <= previous_update_time:
+        logging.info(f"There are no changes to export in {export_job['filename']}")
+        return None
+    changes_query = {UPDATED_AT_FIELD: {'$gt': previous_update_time, '$lte': last_update_time}}
+    fn = pathlib.Path(export_job['filename'])
+    delta_file_name = f"{fn.stem}.{last_update_time.strftime('%Y%m%d%H%M%S%f')}{fn.suffix}"
+    DELTAS_DIR.mkdir(parents=True, exist_ok=True)
+    delta_fn = DELTAS_DIR.joinpath(delta_file_name)
+    if export_job['type'] == 'records':
+        projection, field_transforms = __compile_fields(export_job['fields'])
+        records = db.search(changes_query, projection, stream=True)
+        num_records = __write_records(delta_fn, records, export_job['fields'], field_transforms)
+    else:
+        report = {'records': 0, 'papers': 0, 'papers_without_authors': 0}
+        __write_author_papers(delta_fn, __iter_author_papers(report, changes_query), 'csv', False)
+        num_records = report['papers']
+    job_state['last_update_time'] = __format_time(last_update_time)
+    job_state['deltas'].append(delta_file_name)
+    __save_export_state(export_state)
+    logging.info(f"Exported {num_records} changed records of {export_job['filename']} into {delta_file_name}")
+    return delta_file_name
+
+
+def __get_row_key(export_job, row):
+    # Authorships are identified by their paper, papers without e_id by their DOI
+    if export_job['type'] == 'author_papers':
+        return (row['id'], row['doi']) if row['id'] or row['doi'] else None
+    return row['id'] or None
+
+
+def compact_export(export_job):
+    """
+    Merge the delta files of an export into a new full export. The rows of a
+    record (identified by the column id, and by the DOI in the authorships) in
+    a delta replace all its rows in the previous export and in older deltas.
+    Changed rows that cannot be identified are left out
+    """
+    export_state = __load_export_state()
+    job_state = export_state.get(export_job['filename'])
+    if not job_state or not job_state['deltas']:
+        return
+    changed_rows = dict()
+    num_unidentified_rows = 0
+    for delta_file_name in job_state['deltas']:
+        delta_rows = dict()
+        with open(str(DELTAS_DIR.joinpath(delta_file_name)), 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                row_key = __get_row_key(export_job, row)
+                if row_key is None:
+                    num_unidentified_rows += 1
+                    continue
+                delta_rows.setdefault(row_key, []).append(row)
+        changed_rows.update(delta_rows)
+    if num_unidentified_rows:
+        logging.warning(f"{num_unidentified_rows} changed rows of {export_job['filename']} without id were "
+                        f"left out, export it in full to include them")
+    fn = DATA_DIR.joinpath(export_job['filename'])
+    tmp_fn = fn.with_name(f"{fn.name}.tmp")
+    with open(str(fn), 'r', encoding='utf-8') as f, open(str(tmp_fn), 'w', encoding='utf-8') as tmp_f:
+        reader = csv.DictReader(f)
+        writer = csv.DictWriter(tmp_f, fieldnames=reader.fieldnames)
         writer.writeheader()
-        record_counter, papers_counter, papers_without_authors = 0, 0, 0
-        for paper in papers:
-            paper_authors = paper.get('authors')
-            authors_gender = paper.get('authors_gender')
-            authors_id = paper.get('authors_id')
-            if paper_authors:
-                papers_counter += 1
-                for idx in range(0, len(paper_authors)):
-                    if authors_id[idx] == '[No author name available]':
-                        # skip authors without name
-                        continue
-                    author_name = paper_authors[idx]
-                    record_counter += 1
-                    record_to_save = {
-                        'id': paper['e_id'],
-                        'title': paper['title'],
-                        'doi': paper['DOI'],
-                        'year': paper['year'],
-                        'category': paper['edamCategory'],
-                        'author_id': authors_id[idx],
-                        'author': author_name,
-                        'author_gender': authors_gender[idx],
-                        'author_position': idx+1
-                    }
-                    writer.writerow(record_to_save)
-            else:
-                papers_without_authors += 1
-    logging.info(f"It was exported {papers_counter} papers")
-    logging.info(f"Found {papers_without_authors} papers without authors")
+        for row in reader:
+            if __get_row_key(export_job, row) not in changed_rows:
+                writer.writerow(row)
+        for rows in changed_rows.values():
+            writer.writerows(rows)
+    os.replace(str(tmp_fn), str(fn))
+    __remove_deltas(job_state)
+    logging.info(f"Merged {len(job_state['deltas'])} deltas into {export_job['filename']}, "
+                 f"{len(changed_rows)} records changed")
+    job_state['deltas'] = []
+    __save_export_state(export_state)
+
+
+def export_files_incrementally(export_jobs, num_workers=4, max_deltas=7):
+    """
+    Export only the changes of the exports that were already fully exported in
+    CSV format, the rest are exported in full by export_files_in_parallel. When
+    an export accumulates max_deltas delta files, they are merged into it
+    """
+    export_state = __load_export_state()
+    full_export_jobs = []
+    for export_job in export_jobs:
+        job_state = export_state.get(export_job['filename'])
+        if export_job['file_format'] != 'csv' or not job_state or not job_state.get('last_update_time'):
+            full_export_jobs.append(export_job)
+            continue
+        export_changes(export_job)
+        if len(__load_export_state()[export_job['filename']]['deltas']) >= max_deltas:
+            compact_export(export_job)
+    if full_export_jobs:
+        export_files_in_parallel(full_export_jobs, num_workers=num_workers)
+
+
+def load_author_papers(filename, columns=None):
+    """
+    Load the authorships exported by export_author_papers in any of its formats,
+    the format is taken from the extension of the file (a directory is a
+    Parquet dataset, partitioned by year or written in parallel)
+    :param columns: columns to load, all if None
+    :return: data frame, dictionary encoded columns are loaded as categoricals
+    """
+    fn = pathlib.Path(filename)
+    if not fn.is_absolute() and not fn.exists():
+        fn = pathlib.Path(__file__).parents[0].joinpath('data', filename)
+    if fn.is_dir() or fn.suffix == '.parquet':
+        author_papers = pq.read_table(str(fn), columns=columns).to_pandas()
+    elif fn.suffix == '.feather':
+        author_papers = feather.read_table(str(fn), columns=columns).to_pandas()
+    else:
+        return pd.read_csv(str(fn), usecols=columns, dtype={'category': 'category', 'author_gender': 'category'})
+    if 'year' in author_papers.columns and author_papers['year'].dtype.name == 'category':
+        # The values of the partitions are loaded as categoricals
+        years = author_papers['year'].astype(str).astype('int16')
+        author_papers['year'] = years.where(years != UNKNOWN_YEAR) if (years == UNKNOWN_YEAR).any() else years
+    return author_papers
 
 
 def export_unknown_gender(filename):
@@ -9,9 +9,10 @@ import time
 
 from data_wrangler import create_author_record, update_author_record
 from db_manager import DBManager
+from gender_resolver import get_gender, get_gender_resolver, get_genders
 from pubmed import EntrezClient
 from selenium import webdriver
-from utils import curate_author_name, curate_affiliation_name, load_countries_file, get_gender, title_except, get_config, \
+from utils import curate_author_name, curate_affiliation_name, load_countries_file, title_except, get_config, \
                   get_base_url, are_names_similar, get_similarity_score
 from urllib import parse, request
 
@@ -285,9 +286,9 @@ class AuthorAffiliationExtractor:
             logging.error(f"Paper with doi {paper['DOI']} does not have a link")
 
     def obtain_author_affiliation_from_paper(self, query):
-        papers_db = self.db_papers.search(query)
-        papers = [paper_db for paper_db in papers_db]
-        logging.info(f"Going to process {len(papers)} papers")
+        papers = self.db_papers.search(query, {'DOI': 1, 'link': 1, 'base_url': 1, 'citations': 1, 'authors': 1},
+                                       stream=True)
+        logging.info(f"Going to process {self.db_papers.num_records(query)} papers")
         for paper in papers:
             if paper['link'] == 'https://dx.doi.org/':
                 continue
@@ -434,12 +435,7 @@ def get_authors_ncbi_journal(db):
 
 
 def gender_id(article):
-    genders = []
-    for person in article['authors']:
-        author_gender = get_gender(person)
-        genders.append(author_gender)
-
-    return genders
+    return get_genders(article['authors'])
 
 
 def obtain_author_gender(db):
@@ -793,8 +789,8 @@ def get_paper_author_names_from_pubmed():
     ec = EntrezClient()
     db_papers = DBManager('bioinfo_papers')
     db_authors = DBManager('bioinfo_authors')
-    papers_with_pmid = db_papers.search({'pubmed_id': {'$exists': 1}, 'authors': {'$exists': 0}})
-    papers = [paper_with_pmid for paper_with_pmid in papers_with_pmid]
+    papers = db_papers.search({'pubmed_id': {'$exists': 1}, 'authors': {'$exists': 0}}, {'pubmed_id': 1},
+                              stream=True)
     pm_ids = []
     for paper in papers:
         if paper['pubmed_id']:
@@ -810,6 +806,9 @@ def get_paper_author_names_from_pubmed():
         try:
             logging.info(f"Getting information from the chunk {chunk + 1} of papers. {batch_size} papers in the chunk.")
             results = ec.fetch_in_bulk_from_list(pm_ids[start_chunk:end_chunk])
+            # Papers and authors are updated once the genders of all the
+            # new author names of the chunk have been resolved at once
+            chunk_papers, pending_authors = [], dict()
             # Process results
             for result in results:
                 pm_id = str(result['MedlineCitation']['PMID'])
@@ -826,7 +825,13 @@ def get_paper_author_names_from_pubmed():
                     for author_id in author_ids:
                         paper_dict['author_ids'].append(author_id)
                         author_db = db_authors.find_record({'id': author_id})
-                        if 'first_name' in author_db:
+                        if author_id in pending_authors:
+                            # Author already found in another paper of the chunk
+                            pending_author = pending_authors[author_id]
+                            pending_author['positions'].append((paper_dict, len(paper_dict['author_genders'])))
+                            paper_dict['author_names'].append(pending_author['name'])
+                            paper_dict['author_genders'].append(None)
+                        elif 'first_name' in author_db:
                             paper_dict['author_names'].append(author_db['name'])
                             paper_dict['author_genders'].append(author_db['gender'])
                         else:
@@ -836,16 +841,14 @@ def get_paper_author_names_from_pubmed():
                             if author_pubmed:
                                 if 'ForeName' in author_pubmed:
                                     author_fullname = author_pubmed['ForeName'] + ' ' + author_pubmed['LastName']
-                                    author_gender = get_gender(author_fullname)
-                                    db_authors.update_record({'id': author_id},
-                                                             {'first_name': author_pubmed['ForeName'],
-                                                              'last_name': author_pubmed['LastName'],
-                                                              'name': author_fullname,
-                                                              'gender': author_gender})
-                                    logging.info(f"Updated author with id {author_id}")
+                                    pending_authors[author_id] = {
+                                        'first_name': author_pubmed['ForeName'],
+                                        'last_name': author_pubmed['LastName'],
+                                        'name': author_fullname,
+                                        'positions': [(paper_dict, len(paper_dict['author_genders']))]
+                                    }
                                     paper_dict['author_names'].append(author_fullname)
-                                    paper_dict['author_genders'].append(author_gender)
-                                    num_udpated_authors += 1
+                                    paper_dict['author_genders'].append(None)
                                 elif 'LastName' in author_pubmed:
                                     paper_dict['author_names'].append(author_pubmed['LastName'])
                                     paper_dict['author_genders'].append('unknown')
@@ -853,21 +856,34 @@ def get_paper_author_names_from_pubmed():
                                 paper_dict['author_names'].append(author_db['last_name'])
                                 paper_dict['author_genders'].append('unknown')
                                 authors_not_found.append({'id': author_id, 'paper_doi': paper_db['DOI']})
-                    if len(paper_dict['author_ids']) == len(paper_dict['author_names']) and \
-                       len(paper_dict['author_ids']) == len(paper_dict['author_genders']) and \
-                       len(paper_dict['author_names']) == len(paper_dict['author_genders']):
-                        db_papers.update_record({'_id': paper_db['_id']},
-                                                {'authors': paper_dict['author_names'],
-                                                 'authors_gender': paper_dict['author_genders'],
-                                                 'authors_id': paper_dict['author_ids']})
-                        logging.info(f"Updated paper {paper_db['DOI']}")
-                        num_updated_papers += 1
-                    else:
-                        raise Exception(f"Error when trying to update paper {paper_db['DOI']}, the number of ids, "
-                                        f"names, and gender do not coincide\n\t{paper_dict}")
+                    chunk_papers.append((paper_db, paper_dict))
                 else:
                     logging.info(f"Paper does not have authors list")
                     db_papers.update_record({'_id': paper_db['_id']}, {'no_authors': 1})
+            author_genders = get_genders([pending_author['name'] for pending_author in pending_authors.values()])
+            for (author_id, pending_author), author_gender in zip(pending_authors.items(), author_genders):
+                db_authors.update_record({'id': author_id},
+                                         {'first_name': pending_author['first_name'],
+                                          'last_name': pending_author['last_name'],
+                                          'name': pending_author['name'],
+                                          'gender': author_gender})
+                logging.info(f"Updated author with id {author_id}")
+                for paper_dict, position in pending_author['positions']:
+                    paper_dict['author_genders'][position] = author_gender
+                num_udpated_authors += 1
+            for paper_db, paper_dict in chunk_papers:
+                if len(paper_dict['author_ids']) == len(paper_dict['author_names']) and \
+                   len(paper_dict['author_ids']) == len(paper_dict['author_genders']) and \
+                   len(paper_dict['author_names']) == len(paper_dict['author_genders']):
+                    db_papers.update_record({'_id': paper_db['_id']},
+                                            {'authors': paper_dict['author_names'],
+                                             'authors_gender': paper_dict['author_genders'],
+                                             'authors_id': paper_dict['author_ids']})
+                    logging.info(f"Updated paper {paper_db['DOI']}")
+                    num_updated_papers += 1
+                else:
+                    raise Exception(f"Error when trying to update paper {paper_db['DOI']}, the number of ids, "
+                                    f"names, and gender do not coincide\n\t{paper_dict}")
             # Update indexes
             start_chunk = end_chunk
             end_chunk += batch_size
@@ -880,6 +896,7 @@ def get_paper_author_names_from_pubmed():
                  f"\tNot found authors: {len(authors_not_found)}")
     for author_not_found in authors_not_found:
         logging.info(f"Author Id: {author_not_found['id']}, Paper: {author_not_found['paper_doi']}")
+    get_gender_resolver().log_stats()
 
 
 def get_pubmed_id_from_doi():
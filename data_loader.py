@@ -1,6 +1,8 @@
-from data_wrangler import create_author_record, update_author_record
+from data_wrangler import add_authorship_to_author
 from db_manager import DBManager
 from doiorg_client import DoiClient
+from manifest import IngestManifest, compute_row_hash
+from scopus_reader import iter_scopus_records, read_scopus_file
 from similarity.jarowinkler import JaroWinkler
 from utils import get_db_name, normalize_text, obtain_paper_abstract_and_pubmedid
 
@@ -8,8 +10,10 @@ import ast
 import csv
 import ctypes
 import logging
+import multiprocessing
 import pathlib
 import os
+import zlib
 
 logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
                     level=logging.DEBUG)
@@ -23,9 +27,9 @@ def load_data_from_file_into_db(filename):
     bio_file_name = current_dir.joinpath('data', filename)
     with open(str(bio_file_name), 'r', encoding='ISO-8859-1') as f:
         file = csv.DictReader(f, delimiter='\t')
-        for line in file:
-            line['source'] = line['source'].lower()
-            db.store_record(line)
+        lines = (dict(line, source=line['source'].lower()) for line in file)
+        report = db.store_records(lines)
+    logging.info(f"Inserted {report['inserted']} records, found {report['duplicates']} duplicates")
 
 
 def __affiliations_to_save(affiliations, new_affiliations):
@@ -66,6 +70,7 @@ def __process_paper_authors(paper_summary, paper_full, db_authors, author_names,
     affiliations = paper_full['Affiliations'].split(';')
     paper_doi = paper_summary['DOI']
     paper_citations = paper_summary['Cited by'] if paper_summary['Cited by'] else paper_full['Cited by']
+    processed_author_ids = []
     if author_names:
         it_authors = zip(author_names, author_ids, author_affiliations)
     else:
@@ -80,48 +85,73 @@ def __process_paper_authors(paper_summary, paper_full, db_authors, author_names,
             author_id = full_author[0].strip()
             author_affiliation = ','.join(full_author[1].split(',')[2:]).strip()
             author_last_name = full_author[1].split(',')[0].strip().title()
-        author_db_new = db_authors.find_record({'id': author_id})
+        processed_author_ids.append(author_id)
         actual_affiliations = __get_actual_affiliations(affiliations, author_affiliation)
-        if author_db_new:
-            logging.info(f"Author with id {author_id} already exist")
-            update_author_record(
-                author_in_db=author_db_new,
-                author_name=author_db_new['name'],
-                author_index=author_index,
-                author_gender=author_db_new['gender'],
-                article={'DOI': paper_doi, 'citations': paper_citations},
-                db_authors=db_authors
-            )
-            author_affs = author_db_new['affiliations']
-            affiliations_to_save = __affiliations_to_save(author_affs, actual_affiliations)
-            if len(affiliations_to_save) > 0:
-                author_affs.extend(affiliations_to_save)
-                db_authors.update_record({'id': author_id}, {'affiliations': author_affs})
-        else:
-            if authors_gender:
-                author_gender = authors_gender[author_index]
+        values_on_insert = {
+            'name': author_name,
+            'gender': authors_gender[author_index] if authors_gender else '',
+            'affiliations': actual_affiliations,
+            'last_name': author_last_name,
+            'h-index': 0,
+            'papers_as_last_author': 0
+        }
+        # The author is created or updated in a single atomic
+        # operation, so papers can be loaded concurrently
+        article_added, author_db_new = add_authorship_to_author(
+            author_query={'id': author_id},
+            author_index=author_index,
+            article={'DOI': paper_doi, 'citations': paper_citations},
+            db_authors=db_authors,
+            values_on_insert=values_on_insert,
+            return_fields={'affiliations': 1}
+        )
+        if article_added and not author_db_new:
+            logging.info(f"Author {author_id} creado!")
+            continue
+        logging.info(f"Author with id {author_id} already exist")
+        if not article_added:
+            logging.info(f"The DOI was already processed!")
+            author_db_new = db_authors.find_record({'id': author_id}, {'affiliations': 1})
+        author_affs = author_db_new.get('affiliations') or []
+        affiliations_to_save = __affiliations_to_save(author_affs, actual_affiliations)
+        if len(affiliations_to_save) > 0:
+            if isinstance(author_affs, list):
+                db_authors.find_and_modify_record({'id': author_id},
+                                                  {'$addToSet': {'affiliations': {'$each': affiliations_to_save}}})
             else:
-                author_gender = ''
-            create_author_record(
-                author_name=author_name,
-                author_gender=author_gender,
-                author_index=author_index,
-                article={'DOI': paper_doi, 'citations': paper_citations},
-                db_authors=db_authors,
-                author_id=author_id
-            )
-            db_authors.update_record({'id': author_id}, {'affiliations': actual_affiliations,
-                                                         'last_name': author_last_name})
-
-
-def __process_paper_line(line, exist_old_db, name_old_db, file_name):
-    dc = DoiClient()
-    db_authors_new = DBManager('bioinfo_authors', db_name=get_db_name())
-    db_papers_new = DBManager('bioinfo_papers', db_name=get_db_name())
-    db_papers_old = None
-    if exist_old_db:
-        db_papers_old = DBManager('bioinfo_papers', db_name=name_old_db)
-    paper_new_db = db_papers_new.find_record({'DOI': line['DOI']})
+                db_authors.update_record({'id': author_id}, {'affiliations': affiliations_to_save})
+    return processed_author_ids
+
+
+# The DOI client opens a web browser, so it is created only
+# when needed and reused by all the papers of the process
+_doi_client = None
+
+
+def __get_doi_client():
+    global _doi_client
+    if _doi_client is None:
+        _doi_client = DoiClient()
+    return _doi_client
+
+
+def __get_paper_summary_values(line):
+    # Values of the paper taken from its row in the summary file
+    return {
+        'title': line['Title'],
+        'year': line['Year'],
+        'DOI': line['DOI'],
+        'source': line['Source title'].title(),
+        'volume': line['Volume'],
+        'issue': line['Issue'],
+        'scopus_id': line['Art. No.'],
+        'e_id': line['EID'],
+        'citations': line['Cited by']
+    }
+
+
+def __process_paper_line(line, file_name, db_papers_new, db_papers_old, db_authors_new):
+    paper_new_db = db_papers_new.find_record({'DOI': line['DOI']}, {'_id': 1})
     if not paper_new_db:
         paper_old_db = None
         if db_papers_old:
@@ -136,53 +166,157 @@ def __process_paper_line(line, exist_old_db, name_old_db, file_name):
         else:
             paper_categories = ''
             logging.info(f"Obtaining the link of the paper {line['DOI']}")
-            link = dc.get_paper_link_from_doi(line['DOI'])
+            link = __get_doi_client().get_paper_link_from_doi(line['DOI'])
             authors = []
             authors_gender = []
         abstract, _pubmed_id, paper_full = obtain_paper_abstract_and_pubmedid(file_name, line['EID'])
         if not pubmed_id:
             pubmed_id = _pubmed_id
-        record_to_save = {
-            'title': line['Title'],
-            'year': line['Year'],
-            'DOI': line['DOI'],
-            'source': line['Source title'].title(),
-            'volume': line['Volume'],
-            'issue': line['Issue'],
-            'scopus_id': line['Art. No.'],
+        record_to_save = dict(__get_paper_summary_values(line), **{
             'link': link,
-            'e_id': line['EID'],
-            'citations': line['Cited by'],
             'edamCategory': paper_categories,
             'pubmed_id': pubmed_id,
             'abstract': abstract
-        }
-        db_papers_new.store_record(record_to_save)
+        })
+        if not db_papers_new.store_record(record_to_save):
+            # Another process stored the paper in the meantime
+            return 0, []
         if paper_full:
-            __process_paper_authors(line, paper_full, db_authors_new, authors, authors_gender)
+            return 1, __process_paper_authors(line, paper_full, db_authors_new, authors, authors_gender)
         else:
             logging.error(f"Could not find the full details of the paper {line['DOI']}")
-        return 1
+        return 1, []
     else:
         logging.info(f"Paper {line['DOI']} already in the database!")
-        return 0
+        return 0, []
+
+
+def __get_doi_shard(doi, num_shards):
+    # crc32 is used because, unlike hash(), it is stable across processes
+    return zlib.crc32(doi.encode('utf-8')) % num_shards
+
 
+def __iter_shard_lines(journal_file_name, shard, report):
+    # The DOIs are taken from the record batches, so that rows are only
+    # turned into dictionaries when they belong to the shard
+    for batch in read_scopus_file(journal_file_name):
+        batch_columns = batch.to_pydict()
+        for row_index, doi in enumerate(batch_columns['DOI']):
+            if not doi:
+                # Papers without DOI are counted only once per file
+                if not shard or shard[0] == 0:
+                    report['without_doi'] += 1
+                continue
+            if shard and __get_doi_shard(doi, shard[1]) != shard[0]:
+                continue
+            yield {column_name: values[row_index] for column_name, values in batch_columns.items()}
 
-def load_data_from_files_into_db(exist_old_db=False, name_old_db=''):
+
+def __load_journal_file(file_name, exist_old_db, name_old_db, shard=None, row_hashes=None):
+    """
+    Load the papers of a summary file. If shard, a tuple (shard index, number
+    of shards), is given only the papers whose DOI belong to the shard are loaded.
+    Rows whose hash is in row_hashes (DOI -> hash) were already loaded and are skipped
+    """
+    db_authors_new = DBManager('bioinfo_authors', db_name=get_db_name())
+    db_papers_new = DBManager('bioinfo_papers', db_name=get_db_name())
+    db_papers_old = None
+    if exist_old_db:
+        db_papers_old = DBManager('bioinfo_papers', db_name=name_old_db)
+    report = {'file_name': file_name, 'inserted': 0, 'updated': 0, 'duplicates': 0, 'without_doi': 0,
+              'unchanged': 0, 'author_ids': set(), 'row_hashes': {}}
+    dir_summary = pathlib.Path('data', 'raw', 'summary')
+    journal_file_name = dir_summary.joinpath(file_name)
+    logging.info(f"\nProcessing: {file_name}" + (f" (shard {shard[0] + 1}/{shard[1]})" if shard else ''))
+    for line in __iter_shard_lines(journal_file_name, shard, report):
+        row_hash = compute_row_hash(line)
+        if row_hashes and row_hashes.get(line['DOI']) == row_hash:
+            report['unchanged'] += 1
+            continue
+        if row_hashes and line['DOI'] in row_hashes and \
+                db_papers_new.find_record({'DOI': line['DOI']}, {'_id': 1}):
+            # The row was loaded before and changed since, the stored paper is updated
+            logging.info(f"Updating the paper {line['DOI']}, its row changed")
+            db_papers_new.update_record({'DOI': line['DOI']}, __get_paper_summary_values(line))
+            report['updated'] += 1
+            report['row_hashes'][line['DOI']] = row_hash
+            continue
+        logging.info(f"Processing the paper {line['DOI']}")
+        inserted, author_ids = __process_paper_line(line, file_name, db_papers_new, db_papers_old,
+                                                    db_authors_new)
+        if inserted:
+            report['inserted'] += 1
+        else:
+            report['duplicates'] += 1
+        report['author_ids'].update(author_ids)
+        report['row_hashes'][line['DOI']] = row_hash
+    return report
+
+
+def __load_journal_file_task(task):
+    file_name, exist_old_db, name_old_db, shard, row_hashes = task
+    return __load_journal_file(file_name, exist_old_db, name_old_db, shard, row_hashes=row_hashes)
+
+
+def load_data_from_files_into_db(exist_old_db=False, name_old_db='', num_workers=1, shard_by='file',
+                                 incremental=False):
+    """
+    Load the summary files into the database. With num_workers > 1 the files
+    are loaded by a pool of processes, each one with its own connection to the
+    database. Work is split by journal file (shard_by='file') or by the hash of
+    the DOI of papers (shard_by='doi'). Workers store both papers and authors,
+    authors are updated through atomic operations so the counters of an author
+    shared by papers of different workers stay consistent. If incremental, only
+    the new or changed files and rows since the last run are loaded.
+    """
+    stage = 'load_data_from_files_into_db'
     dir_summary = pathlib.Path('data', 'raw', 'summary')
     file_names = sorted(os.listdir(dir_summary))
-    num_insertions = 0
-    for file_name in file_names:
-        logging.info(f"\nProcessing: {file_name}")
-        journal_file_name = dir_summary.joinpath(file_name)
-        with open(str(journal_file_name), 'r', encoding='utf-8') as f:
-            file = csv.DictReader(f, delimiter=',')
-            for line in file:
-                logging.info(f"Processing the paper {line['DOI']}")
-                if not line['DOI']:
-                    continue
-                num_insertions += __process_paper_line(line, exist_old_db, name_old_db,file_name)
-    logging.info(f"\n{num_insertions} new papers were inserted!")
+    manifest = IngestManifest() if incremental else None
+    files_row_hashes = {file_name: None for file_name in file_names}
+    if manifest:
+        changed_files = manifest.get_changed_files(stage, [dir_summary.joinpath(file_name)
+                                                           for file_name in file_names])
+        files_row_hashes = {changed_file.name: manifest.get_row_hashes(stage, changed_file)
+                            for changed_file in changed_files}
+        logging.info(f"Files changed since the last run: {list(files_row_hashes.keys())}")
+    final_report = {'inserted': 0, 'updated': 0, 'duplicates': 0, 'without_doi': 0, 'unchanged': 0,
+                    'author_ids': set()}
+    if num_workers > 1:
+        if shard_by == 'doi':
+            tasks = [(file_name, exist_old_db, name_old_db, (shard_idx, num_workers), row_hashes)
+                     for file_name, row_hashes in files_row_hashes.items() for shard_idx in range(num_workers)]
+        else:
+            tasks = [(file_name, exist_old_db, name_old_db, None, row_hashes)
+                     for file_name, row_hashes in files_row_hashes.items()]
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            for report in pool.imap_unordered(__load_journal_file_task, tasks):
+                __merge_load_report(final_report, report, manifest, stage)
+    else:
+        for file_name, row_hashes in files_row_hashes.items():
+            report = __load_journal_file(file_name, exist_old_db, name_old_db, row_hashes=row_hashes)
+            __merge_load_report(final_report, report, manifest, stage)
+    if manifest:
+        for file_name in files_row_hashes.keys():
+            manifest.record_file(stage, dir_summary.joinpath(file_name))
+        manifest.save()
+    logging.info(f"\n{final_report['inserted']} new papers were inserted!\n"
+                 f"\tChanged papers updated: {final_report['updated']}\n"
+                 f"\tDuplicates: {final_report['duplicates']}\n"
+                 f"\tPapers without DOI: {final_report['without_doi']}\n"
+                 f"\tUnchanged papers: {final_report['unchanged']}\n"
+                 f"\tAuthors touched: {len(final_report['author_ids'])}")
+    return final_report
+
+
+def __merge_load_report(final_report, report, manifest=None, stage=''):
+    for key in ('inserted', 'updated', 'duplicates', 'without_doi', 'unchanged'):
+        final_report[key] += report[key]
+    final_report['author_ids'].update(report['author_ids'])
+    if manifest:
+        dir_summary = pathlib.Path('data', 'raw', 'summary')
+        manifest.record_row_hashes(stage, dir_summary.joinpath(report['file_name']), report['row_hashes'])
+        manifest.save()
 
 
 def load_author_data_from_scopus_files():
@@ -194,40 +328,37 @@ def load_author_data_from_scopus_files():
     for file_name in file_names:
         logging.info(f"\nProcessing: {file_name}")
         journal_file_name = dir_summary.joinpath(file_name)
-        with open(str(journal_file_name), 'r') as f:
-            file = csv.DictReader(f, delimiter=',')
-            for line in file:
-                paper_db = db_papers.find_record({'DOI': line['DOI']})
-                if paper_db:
-                    logging.info(f"Processing the authors of the paper: {line['DOI']}")
-                    abstract, _pubmed_id, paper_full = obtain_paper_abstract_and_pubmedid(file_name, line['EID'])
-                    __process_paper_authors(line, paper_full, db_authors, [], [])
+        for line in iter_scopus_records(journal_file_name):
+            paper_db = db_papers.find_record({'DOI': line['DOI']})
+            if paper_db:
+                logging.info(f"Processing the authors of the paper: {line['DOI']}")
+                abstract, _pubmed_id, paper_full = obtain_paper_abstract_and_pubmedid(file_name, line['EID'])
+                __process_paper_authors(line, paper_full, db_authors, [], [])
 
 
 def check_data_to_insert():
     dir_summary = pathlib.Path('data', 'raw', 'summary')
     file_names = sorted(os.listdir(dir_summary))
     papers_to_insert = 0
-    journal = []
+    journal = set()
     for file_name in file_names:
         papers_without_doi, num_duplicates, num_papers, unique_papers_journal = 0, 0, 0, 0
         logging.info(f"\nProcessing: {file_name}")
         journal_file_name = dir_summary.joinpath(file_name)
-        with open(str(journal_file_name), 'r', encoding='ISO-8859-1') as f:
-            file = csv.DictReader(f, delimiter=',')
-            for line in file:
+        for batch in read_scopus_file(journal_file_name, columns=['DOI']):
+            for doi in batch.column(0).to_pylist():
                 num_papers += 1
-                if line['DOI']:
-                    if line['DOI'] not in journal:
+                if doi:
+                    if doi not in journal:
                         papers_to_insert += 1
                         unique_papers_journal += 1
-                        journal.append(line['DOI'])
+                        journal.add(doi)
                     else:
                         num_duplicates += 1
                 else:
                     papers_without_doi += 1
-            logging.info(f"Num. Papers: {num_papers}, Num. Unique Papers: {unique_papers_journal}, "
-                         f"Num. Duplicates: {num_duplicates}, Papers without DOI: {papers_without_doi}")
+        logging.info(f"Num. Papers: {num_papers}, Num. Unique Papers: {unique_papers_journal}, "
+                     f"Num. Duplicates: {num_duplicates}, Papers without DOI: {papers_without_doi}")
     logging.info(f"Total of papers to insert (list): {len(journal)}")
     logging.info(f"Total of papers to insert (variable): {papers_to_insert}")
 
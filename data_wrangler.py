@@ -1,8 +1,15 @@
-from db_manager import DBManager
+from bibliometrics import AuthorCitations, compute_bibliometrics, compute_h_index
+from bson import ObjectId
+from db_manager import DBManager, UPDATED_AT_FIELD, track_update
+from gender_resolver import get_genders
 from googleapiclient.discovery import build
+from manifest import IngestManifest
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from recordlinkage import preprocessing, SortedNeighbourhoodIndex, Compare
+from scopus_reader import iter_batch_rows, iter_scopus_records, read_scopus_file
 from selenium import webdriver
-from utils import curate_author_name, get_config, get_base_url, load_countries_file, get_gender, get_db_name, \
+from utils import curate_author_name, get_config, get_base_url, load_countries_file, get_db_name, \
                   obtain_paper_abstract_and_pubmedid, normalize_text
 from similarity.jarowinkler import JaroWinkler
 
@@ -13,6 +20,8 @@ import googlemaps
 import logging
 import pathlib
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 
 
@@ -30,7 +39,7 @@ def create_author_record(author_name, author_gender, author_index, article, db_a
         'name': author_name,
         'gender': author_gender,
         'papers': 1,
-        'total_citations': citations,
+        'total_citations': citations if citations else 0,
         'papers_as_first_author': 1 if author_index == 0 else 0,
         'dois': [article['DOI']],
         'papers_with_citations': 1 if article['citations'] and int(article['citations']) > 0 else 0,
@@ -48,64 +57,97 @@ def create_author_record(author_name, author_gender, author_index, article, db_a
         logging.info(f"Author {author_id} creado!")
 
 
-def update_author_record(author_in_db, author_name, author_index, author_gender, article, db_authors):
-    if 'dois' in author_in_db.keys():
-        author_dois = author_in_db['dois']
-        if article['DOI'] not in author_dois:
-            author_dois.append(article['DOI'])
-        else:
-            logging.info(f"The DOI was already processed!")
-            return
-    else:
-        author_dois = [article['DOI']]
+def __get_authorship_update(author_index, article):
     citations = int(article['citations']) if article['citations'] else ''
-    if 'citations' in author_in_db.keys():
-        author_citations = author_in_db['citations']
-        author_citations.append(citations)
-    else:
-        author_citations = [citations]
-    if 'total_citations' in author_in_db.keys():
-        if citations:
-            try:
-                int(author_in_db['total_citations'])
-                total_citations = citations + author_in_db['total_citations']
-            except:
-                total_citations = citations
-        else:
-            total_citations = author_in_db['total_citations']
-    else:
-        total_citations = int(article['citations']) if citations else 0
-    values_to_update = {
-        'papers': author_in_db['papers'] + 1 if 'papers' in author_in_db.keys() else 1,
-        'total_citations': total_citations,
-        'dois': author_dois,
-        'citations': author_citations
+    return {
+        '$inc': {
+            'papers': 1,
+            'total_citations': citations if citations else 0,
+            'papers_as_first_author': 1 if author_index == 0 else 0,
+            'papers_with_citations': 1 if citations and citations > 0 else 0
+        },
+        # dois and citations are kept aligned, the DOI is not in
+        # the list because of the filter of the update
+        '$push': {'dois': article['DOI'], 'citations': citations}
     }
-    if author_index == 0:
-        if 'papers_as_first_author' in author_in_db.keys():
-            values_to_update['papers_as_first_author'] = author_in_db['papers_as_first_author'] + 1
-        else:
-            values_to_update['papers_as_first_author'] = 1
-    if citations and citations > 0:
-        if 'papers_with_citations' in author_in_db.keys():
-            values_to_update['papers_with_citations'] = author_in_db['papers_with_citations'] + 1
-        else:
-            values_to_update['papers_with_citations'] = 1
+
+
+def __get_new_author_record(author_index, article, values_on_insert):
+    # Record of an author created with the article as its only paper
+    citations = int(article['citations']) if article['citations'] else ''
+    return dict(values_on_insert, **{
+        'papers': 1,
+        'total_citations': citations if citations else 0,
+        'papers_as_first_author': 1 if author_index == 0 else 0,
+        'papers_with_citations': 1 if citations and citations > 0 else 0,
+        'dois': [article['DOI']],
+        'citations': [citations]
+    })
+
+
+def add_authorship_to_author(author_query, author_index, article, db_authors, values_on_insert=None,
+                             return_fields=None):
+    """
+    Add the article to the metrics of the author in a single atomic update
+    that only applies if the DOI of the article is not yet among the DOIs
+    of the author, so concurrent writers never lose or double count papers.
+    If values_on_insert is given, the author is created with them when it
+    does not exist.
+    :return: tuple (whether the article was added, record of the author before
+    the update or None if the author was created)
+    """
+    filter_query = dict(author_query, dois={'$ne': article['DOI']})
+    update = __get_authorship_update(author_index, article)
+    citations_fixed = False
+    for _ in range(3):
+        try:
+            author_before = db_authors.find_and_modify_record(filter_query, update, return_fields=return_fields)
+        except OperationFailure as e:
+            # findAndModify reports the failed $inc as a TypeMismatch (code 14)
+            if e.code != 14 or citations_fixed:
+                raise
+            # Authors without citations used to be stored with '' as
+            # total citations, which cannot be incremented
+            db_authors.update_records(dict(author_query, total_citations=''), {'total_citations': 0})
+            citations_fixed = True
+            continue
+        if author_before is not None:
+            return True, author_before
+        if values_on_insert is None:
+            # Either the author does not exist or the article was already added
+            return False, None
+        # The author is created only if there isn't any record matching
+        # the query, an author that already has the article is left untouched
+        new_author = __get_new_author_record(author_index, article, values_on_insert)
+        try:
+            author_created = db_authors.insert_record_if_missing(author_query, new_author)
+        except DuplicateKeyError:
+            # Another writer created the author meanwhile, add the article to it
+            continue
+        return author_created, None
+    return False, None
+
+
+def update_author_record(author_in_db, author_name, author_index, author_gender, article, db_authors):
+    if 'id' in author_in_db:
+        author_query = {'id': author_in_db['id']}
+    elif author_name:
+        author_query = {'name': author_name}
+    else:
+        logging.error(f"The author cannot be updated because there is not a way to identify the record "
+                      f"in the database")
+        return
+    article_added, _ = add_authorship_to_author(author_query, author_index, article, db_authors)
+    if not article_added:
+        logging.info(f"The DOI was already processed!")
+        return
     # check if the stored gender of the author is unknown, if
     # this is the case replace with the current one
-    if author_in_db.get('gender') == 'unknown':
-        values_to_update['gender'] = author_gender
+    if author_in_db.get('gender') == 'unknown' and author_gender != 'unknown':
+        db_authors.update_record(dict(author_query, gender='unknown'), {'gender': author_gender})
     if author_gender != 'unknown' and author_gender != author_in_db.get('gender'):
         logging.warning(f"Author {author_name}'s with gender inconsistency. "
                         f"Stored {author_in_db.get('gender')}. Article (doi {article['DOI']}) author_gender")
-    if 'id' in author_in_db:
-        db_authors.update_record({'id': author_in_db['id']}, values_to_update)
-    else:
-        if author_name:
-            db_authors.update_record({'name': author_name}, values_to_update)
-        else:
-            logging.error(f"The author cannot be updated because there is not a way to identify the record "
-                          f"in the database")
     if author_name:
         logging.info(f"Actualizado author {author_name}")
     elif 'last_name' in author_in_db:
@@ -140,70 +182,30 @@ def create_update_paper_authors_collection():
                 create_author_record(author, author_gender, index, article, db_authors)
 
 
-def update_author_metrics():
-    """
-    Update the authors' metrics: papers with citations and papers as first author
-    :return:
-    """
-    db_authors = DBManager('bioinfo_authors')
-    db_papers = DBManager('bioinfo_papers')
-    authors_db = db_authors.search({})
-    authors = [author_db for author_db in authors_db]
-    processed_authors = []
-    total_authors = len(authors)
-    for num_author, author in enumerate(authors):
-        logging.info(f"Processing author: {author['name']} ({num_author+1}/{total_authors})")
-        for doi in author['dois']:
-            paper_db = db_papers.find_record({'DOI': doi})
-            if paper_db:
-                index = paper_db['authors'].index(author['name'])
-                if author['name'] not in processed_authors:
-                    # First time
-                    processed_authors.append(author['name'])
-                    new_vals = {
-                        'papers_with_citations': 1 if int(paper_db['citations']) > 0 else 0,
-                        'papers_as_first_author': 1 if index == 0 else 0
-                    }
-                else:
-                    papers_with_citations = author['papers_with_citations']
-                    if int(paper_db['citations']) > 0:
-                        papers_with_citations += 1
-                    papers_as_first_author = author['papers_as_first_author']
-                    if index == 0:
-                        papers_as_first_author += + 1
-                    new_vals = {
-                        'papers_with_citations': papers_with_citations,
-                        'papers_as_first_author': papers_as_first_author
-                    }
-                db_authors.update_record({'name': author['name']}, new_vals)
-
-
 def do_compute_h_index(author):
-    author_citations = author['citations']
-    h_index = author['papers_with_citations']
-    if h_index > 0:
-        while True:
-            greater_counter = 0
-            for citation in author_citations:
-                if citation >= h_index:
-                    greater_counter += 1
-            if greater_counter >= h_index:
-                break
-            else:
-                h_index -= 1
-    return h_index
+    return int(compute_h_index(AuthorCitations([author.get('citations', [])]))[0])
 
 
-def compute_authors_h_index(override_metric=False):
-    db_authors = DBManager('bioinfo_authors')
-    authors = db_authors.search({})
-    for author in authors:
-        if 'h-index' in author.keys() and not override_metric:
-            continue
-        logging.info(f"Computing h-index of {author['name']}")
-        h_index = do_compute_h_index(author)
-        logging.info(f"{author['name']} has an h-index of {h_index}")
-        db_authors.update_record({'name': author['name']}, {'h-index': h_index})
+def compute_authors_bibliometrics(metrics=None, chunk_size=10000):
+    """
+    Compute the bibliometric indicators (see METRICS in bibliometrics.py) of
+    all the authors. The citations of authors are read in a single projected
+    scan and the metrics of each chunk of authors are computed at once and
+    written back in bulk
+    :param metrics: names of the metrics to compute, all if None
+    """
+    db_authors = DBManager('bioinfo_authors', db_name=get_db_name())
+    num_authors = 0
+    with db_authors.bulk_writer() as bulk:
+        for authors in db_authors.search_in_chunks({}, {'citations': 1}, chunk_size):
+            author_metrics = compute_bibliometrics([author.get('citations') or [] for author in authors], metrics)
+            for index, author in enumerate(authors):
+                # Values are converted from NumPy types so that they can be encoded as BSON
+                values_to_update = {metric_name: values[index].item() for metric_name, values in author_metrics.items()}
+                bulk.update({'_id': author['_id']}, values_to_update)
+            num_authors += len(authors)
+            logging.info(f"Computed the bibliometrics of {num_authors} authors")
+    logging.info(f"Bibliometrics of {num_authors} authors updated: {bulk.totals}")
 
 
 def clean_author_countries():
@@ -279,11 +281,11 @@ def curate_authors_name():
 def compute_paper_base_url():
     db_papers = DBManager('bioinfo_papers')
     papers = db_papers.search({})
-    papers_list = [paper_db for paper_db in papers]
-    for paper in papers_list:
-        base_url = get_base_url(paper['link'])
-        logging.info(f"Paper full url {paper['link']}, base url {base_url}")
-        db_papers.update_record({'DOI': paper['DOI']}, {'base_url': base_url})
+    with db_papers.bulk_writer() as bulk:
+        for paper in papers:
+            base_url = get_base_url(paper['link'])
+            logging.info(f"Paper full url {paper['link']}, base url {base_url}")
+            bulk.update({'DOI': paper['DOI']}, {'base_url': base_url})
 
 
 def __update_with_ncbi_link(res_item, paper, driver, db_papers):
@@ -368,18 +370,25 @@ def complete_author_genders():
     papers = [paper_db for paper_db in papers_db]
     for paper in papers:
         authors = paper['authors']
-        author_genders = []
-        for index, author in enumerate(authors):
-            author_db = db_authors.find_record({'name': author})
+        authors_db = [db_authors.find_record({'name': author}) for author in authors]
+        # Resolve at once the genders of the authors that don't have one yet
+        names_to_resolve = [author for author, author_db in zip(authors, authors_db)
+                            if not author_db or 'gender' not in author_db.keys()]
+        resolved_genders = dict(zip(names_to_resolve, get_genders(names_to_resolve)))
+        author_genders, created_authors = [], set()
+        for index, (author, author_db) in enumerate(zip(authors, authors_db)):
             if author_db:
                 if 'gender' in author_db.keys():
                     author_genders.append(author_db['gender'])
                 else:
-                    author_genders.append(get_gender(author))
+                    author_genders.append(resolved_genders[author])
             else:
-                author_gender = get_gender(author)
+                author_gender = resolved_genders[author]
                 author_genders.append(author_gender)
-                create_author_record(author, author_gender, index, paper, db_authors)
+                # The same name may appear twice in the list of authors
+                if author not in created_authors:
+                    create_author_record(author, author_gender, index, paper, db_authors)
+                    created_authors.add(author)
         db_papers.update_record({'DOI': paper['DOI']}, {'authors_gender': author_genders})
 
 
@@ -668,124 +677,218 @@ def label_papers_with_all_authors_with_delete_flag():
     logging.info(f"{papers_flagged} papers were flagged")
 
 
-def compute_metric_papers_as_last_author():
-    db_papers = DBManager('bioinfo_papers')
-    db_authors = DBManager('bioinfo_authors')
-    papers = db_papers.search({})
-    db_authors.update_all_records({'papers_as_last_author': 0})
-    for paper in papers:
-        author_ids = paper['authors_id']
-        if len(author_ids) > 0:
-            last_author_id = author_ids[-1]
-            logging.info(f"Updating the record of {last_author_id}")
-            author_db = db_authors.find_record({'id': last_author_id})
-            if author_db:
-                papers_as_last_author = author_db['papers_as_last_author']
-                papers_as_last_author += 1
-                db_authors.update_record({'id': last_author_id},
-                                         {'papers_as_last_author': papers_as_last_author})
-            else:
-                logging.info(f"Author {last_author_id} does not exist")
-
-
-def fix_author_metrics():
-    db_authors = DBManager('bioinfo_authors')
-    db_papers = DBManager('bioinfo_papers')
-    authors = db_authors.search({'updated_dt': {'$exists': 0}})
-    tot_authors = authors.count()
-    author_counter = 1
+def compute_authors_paper_metrics():
+    """
+    Compute the metrics papers, papers_as_first_author, papers_as_last_author,
+    papers_with_citations, and total_citations of authors with a single
+    aggregation over the papers that is executed in the database. Results are
+    merged into the records of the authors, identified by their ids
+    """
+    db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
+    db_authors = DBManager('bioinfo_authors', db_name=get_db_name())
+    metrics = ['papers', 'papers_as_first_author', 'papers_as_last_author', 'papers_with_citations',
+               'total_citations']
+    project = {
+        'authors_id': 1,
+        'num_authors': {'$size': '$authors_id'},
+        'citations': {'$convert': {'input': '$citations', 'to': 'int', 'onError': 0, 'onNull': 0}}
+    }
+    group = {
+        '_id': '$authors_id',
+        'papers': {'$sum': 1},
+        'papers_as_first_author': {'$sum': {'$cond': [{'$eq': ['$author_index', 0]}, 1, 0]}},
+        'papers_as_last_author': {
+            '$sum': {'$cond': [{'$eq': ['$author_index', {'$subtract': ['$num_authors', 1]}]}, 1, 0]}
+        },
+        'papers_with_citations': {'$sum': {'$cond': [{'$gt': ['$citations', 0]}, 1, 0]}},
+        'total_citations': {'$sum': '$citations'}
+    }
+    # The _id of the author record is looked up so that results can be merged
+    # on it, the unique index on the author id is partial and $merge cannot use it
+    lookup = {
+        'from': db_authors.collection_name,
+        'localField': '_id',
+        'foreignField': 'id',
+        'as': 'author'
+    }
+    # The update time of authors is only changed when some of their metrics change
+    unchanged_metrics = {'$and': [{'$eq': [f"${metric}", f"$$new.{metric}"]} for metric in metrics]}
+    merge_metrics = dict({metric: f"$$new.{metric}" for metric in metrics},
+                         **{UPDATED_AT_FIELD: {'$cond': [unchanged_metrics, f"${UPDATED_AT_FIELD}", '$$NOW']}})
+    merge = {
+        'into': db_authors.collection_name,
+        'on': '_id',
+        'whenMatched': [{'$set': merge_metrics}],
+        'whenNotMatched': 'discard'
+    }
+    pipeline = [
+        {'$match': {'authors_id.0': {'$exists': True}}},
+        {'$project': project},
+        {'$unwind': {'path': '$authors_id', 'includeArrayIndex': 'author_index'}},
+        {'$group': group},
+        {'$lookup': lookup},
+        {'$unwind': '$author'},
+        {'$project': dict({'_id': '$author._id'}, **{metric: 1 for metric in metrics})},
+        {'$merge': merge}
+    ]
+    logging.info('Computing the paper metrics of authors in the database...')
+    db_papers.aggregate(pipeline)
+    # Authors without papers are not produced by the aggregation, their metrics are reset
+    author_ids_with_papers = {author['_id'] for author in db_papers.aggregate_stream([
+        {'$unwind': '$authors_id'},
+        {'$group': {'_id': '$authors_id'}}
+    ])}
+    authors_with_metrics = db_authors.search({'id': {'$exists': True},
+                                              '$or': [{metric: {'$ne': 0}} for metric in metrics]},
+                                             {'id': 1}, stream=True)
+    with db_authors.bulk_writer() as bulk:
+        for author in authors_with_metrics:
+            if author['id'] not in author_ids_with_papers:
+                bulk.update({'_id': author['_id']}, {metric: 0 for metric in metrics})
+    logging.info(f"Paper metrics of {db_authors.num_records({'papers': {'$gt': 0}})} authors updated, "
+                 f"{bulk.totals['modified']} authors without papers reset")
+
+
+def __load_papers_by_doi(db_papers):
+    papers_by_doi = dict()
+    for paper in db_papers.search({}, {'DOI': 1, 'authors': 1, 'citations': 1}, stream=True):
+        try:
+            citations = int(paper.get('citations'))
+        except (TypeError, ValueError):
+            citations = 0
+        papers_by_doi[paper['DOI']] = (paper.get('authors') or [], citations)
+    return papers_by_doi
+
+
+def __find_author_position(author, author_names, paper_authors, jarowinkler):
+    """
+    :return: tuple (position of the author in the list of authors of the paper or -1 if
+    the author is not found, position and similarity of the most similar name)
+    """
+    max_similarity_idx, max_similarity_score = -1, -10000
+    for idx, paper_author in enumerate(paper_authors):
+        if paper_author in author_names:
+            return idx, idx, 1
+        similarity_score = jarowinkler.similarity(author['name'], paper_author)
+        if similarity_score > max_similarity_score:
+            max_similarity_idx = idx
+            max_similarity_score = similarity_score
+    return -1, max_similarity_idx, max_similarity_score
+
+
+def rebuild_author_metrics(pending_only=False, review_file_name='author_metrics_review.csv'):
+    """
+    Rebuild the metrics of authors from the papers stored in the database in a
+    single pass. Papers are loaded once into memory by DOI and the updates of
+    authors are written in bulk. Authors who cannot be found by name in the
+    list of authors of one of their papers are written, together with the most
+    similar name of the paper, to a review file in the directory data. The
+    reviewed file can be applied with add_reviewed_alternative_names
+    :param pending_only: rebuild only the metrics of authors that were not rebuilt before
+    """
+    db_authors = DBManager('bioinfo_authors', db_name=get_db_name())
+    db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
+    papers_by_doi = __load_papers_by_doi(db_papers)
+    logging.info(f"Loaded {len(papers_by_doi)} papers")
+    query = {'updated_dt': {'$exists': 0}} if pending_only else {}
+    metric_fields = ['papers', 'total_citations', 'papers_as_first_author', 'papers_with_citations', 'citations',
+                     'papers_as_last_author']
+    authors = db_authors.search(query, dict({'name': 1, 'other_names': 1, 'dois': 1, 'updated_dt': 1},
+                                            **{metric: 1 for metric in metric_fields}), stream=True)
     jarowinkler = JaroWinkler()
-    for author in authors:
-        logging.info(f"[{author_counter}/{tot_authors}] Updating the author: {author['name']}")
-        author_names = [author['name']]
-        if 'other_names' in author.keys():
-            author_names.extend(author['other_names'])
-        total_citations, papers_with_citations, papers_as_first_author, papers_as_last_author = 0, 0, 0, 0
-        list_citations = []
-        is_alternative, other_name = '', ''
-        for doi in author['dois']:
-            paper_db = db_papers.find_record({'DOI': doi})
-            citations = int(paper_db['citations'])
-            total_citations += citations
-            list_citations.append(citations)
-            if citations > 0:
-                papers_with_citations += 1
-            idx = 0
-            found_author = False
-            max_similarity_idx, max_similarity_score = -1, -10000
-            for idx in range(0, len(paper_db['authors'])):
-                if paper_db['authors'][idx] in author_names:
-                    found_author = True
-                    break
-                else:
-                    similarity_score = jarowinkler.similarity(author['name'], paper_db['authors'][idx])
-                    if similarity_score > max_similarity_score:
-                        max_similarity_idx = idx
-                        max_similarity_score = similarity_score
-            if found_author:
-                if idx == 0:
+    review_fieldnames = ['author_id', 'author_name', 'doi', 'candidate_name', 'similarity', 'is_alternative']
+    num_authors, num_reviews = 0, 0
+    review_file_path = pathlib.Path('data').joinpath(review_file_name)
+    with open(str(review_file_path), 'w', encoding='utf-8') as review_file, db_authors.bulk_writer() as bulk:
+        review_writer = csv.DictWriter(review_file, fieldnames=review_fieldnames)
+        review_writer.writeheader()
+        for author in authors:
+            author_names = {author['name']}
+            author_names.update(author.get('other_names') or [])
+            total_citations, papers_with_citations, papers_as_first_author, papers_as_last_author = 0, 0, 0, 0
+            list_citations = []
+            for doi in author.get('dois') or []:
+                if doi not in papers_by_doi:
+                    logging.warning(f"The paper {doi} of the author {author['name']} is not in the database")
+                    continue
+                paper_authors, citations = papers_by_doi[doi]
+                total_citations += citations
+                list_citations.append(citations)
+                if citations > 0:
+                    papers_with_citations += 1
+                idx, max_similarity_idx, max_similarity_score = \
+                    __find_author_position(author, author_names, paper_authors, jarowinkler)
+                if idx == -1:
+                    num_reviews += 1
+                    review_writer.writerow({
+                        'author_id': str(author['_id']),
+                        'author_name': author['name'],
+                        'doi': doi,
+                        'candidate_name': paper_authors[max_similarity_idx] if max_similarity_idx >= 0 else '',
+                        'similarity': round(max_similarity_score, 4) if max_similarity_idx >= 0 else '',
+                        'is_alternative': ''
+                    })
+                elif idx == 0:
                     papers_as_first_author += 1
-                else:
-                    if (idx+1) == len(paper_db['authors']):
-                        papers_as_last_author += 1
-            else:
-                print(f"Could not find the author {author['name']} in the paper {doi}")
-                is_alternative = str(input(f"Is {paper_db['authors'][max_similarity_idx]} an alternative name of "
-                                           f"{author['name']}? (y/n) "))
-                if is_alternative == 'y':
-                    other_name = paper_db['authors'][max_similarity_idx]
-                    if max_similarity_idx == 0:
-                        papers_as_first_author += 1
-                    elif (max_similarity_idx+1) == len(paper_db['authors']):
-                        papers_as_last_author += 1
-        author_dict = {
-            'papers': len(author['dois']),
-            'total_citations': total_citations,
-            'papers_as_first_author': papers_as_first_author,
-            'papers_with_citations': papers_with_citations,
-            'citations': list_citations,
-            'papers_as_last_author': papers_as_last_author,
-            'updated_dt': datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-        }
-        if is_alternative == 'y':
-            other_names = [other_name]
-            if 'other_names' in author.keys():
-                other_names.extend(author['other_names'])
-            author_dict['other_names'] = other_names
-        db_authors.update_record({'_id': author['_id']}, author_dict)
-        author_counter += 1
+                elif (idx+1) == len(paper_authors):
+                    papers_as_last_author += 1
+            author_metrics = {
+                'papers': len(author.get('dois') or []),
+                'total_citations': total_citations,
+                'papers_as_first_author': papers_as_first_author,
+                'papers_with_citations': papers_with_citations,
+                'citations': list_citations,
+                'papers_as_last_author': papers_as_last_author
+            }
+            # Authors are only written when some of their metrics change, or
+            # when they were never rebuilt, so they keep their update time
+            if 'updated_dt' not in author or \
+                    any(author.get(metric) != value for metric, value in author_metrics.items()):
+                author_metrics['updated_dt'] = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+                bulk.update({'_id': author['_id']}, author_metrics)
+            num_authors += 1
+            if num_authors % 10000 == 0:
+                logging.info(f"Rebuilt the metrics of {num_authors} authors")
+    logging.info(f"Rebuilt the metrics of {num_authors} authors: {bulk.totals}. {num_reviews} name matches "
+                 f"to review in {review_file_path}")
+
+
+def add_reviewed_alternative_names(review_file_name='author_metrics_review.csv'):
+    """
+    Add as alternative names of authors the candidate names marked with 'y' in the
+    column is_alternative of the review file written by rebuild_author_metrics.
+    Rebuild the metrics afterwards so that the new names are taken into account
+    """
+    db_authors = DBManager('bioinfo_authors', db_name=get_db_name())
+    with open(str(pathlib.Path('data').joinpath(review_file_name)), 'r', encoding='utf-8') as review_file, \
+            db_authors.bulk_writer() as bulk:
+        for row in csv.DictReader(review_file):
+            if row['is_alternative'].strip().lower() == 'y' and row['candidate_name']:
+                # Authors that already have the name are not touched
+                bulk.add(UpdateOne({'_id': ObjectId(row['author_id']), 'other_names': {'$ne': row['candidate_name']}},
+                                   track_update({'$addToSet': {'other_names': row['candidate_name']}})))
+    logging.info(f"Alternative names added: {bulk.totals['modified']}")
 
 
 def create_affiliation_collection():
     db_authors = DBManager('bioinfo_authors')
     db_affiliations = DBManager('bioinfo_affiliations')
-    authors = db_authors.search({})
-    num_affiliations = 0
-    for author in authors:
-        if 'affiliations' in author:
-            author_affiliations = author['affiliations']
-            for author_affiliation in author_affiliations:
-                affiliation = db_affiliations.find_record({'name': author_affiliation})
-                if affiliation:
-                    logging.info(f"Updating affiliation: {author_affiliation}")
-                    author_ids = affiliation['author_ids']
-                    author_ids.append(author['_id'])
-                    db_affiliations.update_record({'name': author_affiliation}, {'author_ids': author_ids})
-                else:
-                    logging.info(f"Creating affiliation: {author_affiliation}")
-                    db_affiliations.store_record(
-                        {'name': author_affiliation,
-                         'country': '',
-                         'city': '',
-                         'latitude': '',
-                         'longitude': '',
-                         'author_ids': [author['_id']]
-                         }
-                    )
-                    num_affiliations += 1
-        else:
-            logging.info(f"The author {author['name']} does not have affiliations")
-    logging.info(f"Affiliations created: {num_affiliations}")
+    authors = db_authors.search({}, {'name': 1, 'affiliations': 1})
+    with db_affiliations.bulk_writer() as bulk:
+        for author in authors:
+            if 'affiliations' in author:
+                for author_affiliation in author['affiliations']:
+                    # Create the affiliation if it does not exist and
+                    # add the author to it in the same operation
+                    bulk.add(UpdateOne(
+                        {'name': author_affiliation},
+                        {'$setOnInsert': {'country': '', 'city': '', 'latitude': '', 'longitude': ''},
+                         '$addToSet': {'author_ids': author['_id']}},
+                        upsert=True
+                    ))
+            else:
+                logging.info(f"The author {author['name']} does not have affiliations")
+    logging.info(f"Affiliations created: {bulk.totals['upserted']}")
 
 
 def process_affiliations():
@@ -814,70 +917,160 @@ def process_affiliations():
             logging.info(f"Returned status: {geocode_result['status']}")
 
 
-def __save_dataframe_to_csv(dataframe, name):
-    journal_csv_file = pathlib.Path('data', 'processed').joinpath(name + '.csv')
-    logging.info(f"Saving {dataframe.shape[0]} records in {journal_csv_file}")
-    dataframe.to_csv(journal_csv_file, index=False)
-
-
-def combine_csv_files():
+def __get_journal_name(file_name):
+    return '_'.join([token for token in file_name.split('_') if token.isalpha()])
+
+
+def __get_journal_columns(journal_file_names):
+    # Read only the headers, the exports of a journal might not
+    # have exactly the same columns
+    columns = []
+    for file_name in journal_file_names:
+        for column in pd.read_csv(file_name, nrows=0).columns:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def __combine_journal_files(journal_name, journal_file_names, chunk_size, csv_mirror):
+    dir_processed = pathlib.Path('data', 'processed')
+    parquet_file = dir_processed.joinpath(journal_name + '.parquet')
+    csv_file = dir_processed.joinpath(journal_name + '.csv')
+    tmp_parquet_file = dir_processed.joinpath(f".{journal_name}.parquet.tmp")
+    tmp_csv_file = dir_processed.joinpath(f".{journal_name}.csv.tmp")
+    columns = __get_journal_columns(journal_file_names)
+    # All the columns are read as strings, so their types do not
+    # depend on the content of each chunk
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    num_articles = 0
+    writer = pq.ParquetWriter(str(tmp_parquet_file), schema)
+    try:
+        for file_name in journal_file_names:
+            logging.info(f"\nProcessing: {file_name.name}")
+            chunks = pd.read_csv(file_name, dtype=str, keep_default_na=False, chunksize=chunk_size)
+            for chunk in chunks:
+                chunk = chunk.reindex(columns=columns, fill_value='').sort_values('EID')
+                # Every chunk is written as a row group sorted by EID, rows are
+                # not sorted across row groups, which would need the whole journal
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                if csv_mirror:
+                    chunk.to_csv(tmp_csv_file, index=False, mode='a' if num_articles else 'w',
+                                 header=not num_articles)
+                num_articles += chunk.shape[0]
+                logging.info(f"Num. Articles: {num_articles}")
+    finally:
+        writer.close()
+    os.replace(str(tmp_parquet_file), str(parquet_file))
+    if csv_mirror:
+        os.replace(str(tmp_csv_file), str(csv_file))
+    logging.info(f"Saved {num_articles} records in {parquet_file}")
+
+
+def combine_csv_files(incremental=False, chunk_size=1000, csv_mirror=False):
+    """
+    Combine the files in data/raw/full into one Parquet file per journal,
+    reading them in chunks of chunk_size rows. Rows are sorted by EID within
+    each chunk. If csv_mirror, a CSV copy of the file is also written for
+    external readers that expect CSV files. If incremental,
+    only the journals with new, changed, or removed raw files are combined again
+    """
+    stage = 'combine_csv_files'
     dir = pathlib.Path('data', 'raw', 'full')
+    dir_processed = pathlib.Path('data', 'processed')
     file_names = sorted(os.listdir(dir))
-    journal_name, master_name = '', ''
-    master_df = None
-    logging.info('Starting the combination of csv files...')
+    journal_files = dict()
     for file_name in file_names:
-        logging.info(f"\nProcessing: {file_name}")
-        journal_name = '_'.join([token for token in file_name.split('_') if token.isalpha()])
-        file_name = dir.joinpath(file_name)
-        if master_name != journal_name:
-            if master_df is not None:
-                __save_dataframe_to_csv(master_df, master_name)
-            master_df = pd.read_csv(file_name, index_col='DOI')
-            logging.info(f"Num. Articles: {master_df.shape[0]}")
-            master_name = journal_name
-        else:
-            aux_df = pd.read_csv(file_name, index_col='DOI')
-            logging.info(f"Num. Articles: {aux_df.shape[0]}")
-            master_df = master_df.append(aux_df, ignore_index=True)
-    __save_dataframe_to_csv(master_df, master_name)
+        journal_files.setdefault(__get_journal_name(file_name), []).append(dir.joinpath(file_name))
+    manifest = IngestManifest() if incremental else None
+    removed_files = dict()
+    if manifest:
+        changes = manifest.get_changes(stage, [dir.joinpath(file_name) for file_name in file_names])
+        for removed_file in changes['removed']:
+            removed_files.setdefault(__get_journal_name(pathlib.Path(removed_file).name), []).append(removed_file)
+    logging.info('Starting the combination of csv files...')
+    for journal_name, journal_file_names in journal_files.items():
+        if manifest:
+            journal_parquet_file = dir_processed.joinpath(journal_name + '.parquet')
+            if journal_parquet_file.exists() and journal_name not in removed_files and \
+                    not manifest.get_changed_files(stage, journal_file_names):
+                logging.info(f"\nSkipping {journal_name}, its files did not change since the last run")
+                continue
+        __combine_journal_files(journal_name, journal_file_names, chunk_size, csv_mirror)
+        if manifest:
+            for file_name in journal_file_names:
+                manifest.record_file(stage, file_name)
+            for removed_file in removed_files.get(journal_name, []):
+                manifest.forget_file(stage, removed_file)
+            manifest.save()
+    # The combined files of journals whose raw files were all removed are stale
+    for journal_name in removed_files.keys() - journal_files.keys():
+        logging.info(f"\nRemoving the combined files of {journal_name}, its raw files were removed")
+        for combined_file in (dir_processed.joinpath(journal_name + '.parquet'),
+                              dir_processed.joinpath(journal_name + '.csv')):
+            if combined_file.exists():
+                combined_file.unlink()
+        for removed_file in removed_files[journal_name]:
+            manifest.forget_file(stage, removed_file)
+        manifest.save()
 
 
 def standardize_source_name():
     db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
     papers_db = db_papers.search({})
-    for paper_db in papers_db:
-        db_papers.update_record({'DOI': paper_db['DOI']}, {'source': paper_db['source'].title()})
+    with db_papers.bulk_writer() as bulk:
+        for paper_db in papers_db:
+            bulk.update({'DOI': paper_db['DOI']}, {'source': paper_db['source'].title()})
 
 
-def add_author_ids_to_papers():
+def add_author_ids_to_papers(incremental=False):
+    """
+    Add to the papers the ids of their authors. If incremental, only the
+    new or changed rows of the summary files are processed
+    """
+    stage = 'add_author_ids_to_papers'
     db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
     dir_summary = pathlib.Path('data', 'raw', 'summary')
-    file_names = sorted(os.listdir(dir_summary))
-    for file_name in file_names:
-        logging.info(f"\nProcessing: {file_name}")
-        journal_file_name = dir_summary.joinpath(file_name)
-        with open(str(journal_file_name), 'r') as f:
-            file = csv.DictReader(f, delimiter=',')
-            for line in file:
-                paper_doi = line['DOI']
-                logging.info(f"Processing paper {paper_doi}")
-                author_ids = [author_id.strip() for author_id in line['Author(s) ID'].split(';')]
-                logging.info(f"Adding the following ids {author_ids} to the paper")
-                db_papers.update_record({'DOI': paper_doi}, {'authors_id': author_ids})
+    file_names = [dir_summary.joinpath(file_name) for file_name in sorted(os.listdir(dir_summary))]
+    manifest = IngestManifest() if incremental else None
+    if manifest:
+        file_names = manifest.get_changed_files(stage, file_names)
+    with db_papers.bulk_writer() as bulk:
+        for journal_file_name in file_names:
+            logging.info(f"\nProcessing: {journal_file_name.name}")
+            # Rows are only needed whole to track their changes in the manifest
+            columns = None if manifest else ['DOI', 'Author(s) ID']
+            for batch in read_scopus_file(journal_file_name, columns=columns):
+                dois = batch.column(batch.schema.get_field_index('DOI')).to_pylist()
+                authors_ids = batch.column(batch.schema.get_field_index('author_ids')).to_pylist()
+                lines = iter_batch_rows(batch) if manifest else [None] * batch.num_rows
+                for paper_doi, author_ids, line in zip(dois, authors_ids, lines):
+                    if manifest and not manifest.is_row_changed(stage, journal_file_name, paper_doi, line):
+                        continue
+                    logging.info(f"Processing paper {paper_doi}")
+                    logging.info(f"Adding the following ids {author_ids} to the paper")
+                    bulk.update({'DOI': paper_doi}, {'authors_id': author_ids})
+                    if manifest:
+                        manifest.record_row(stage, journal_file_name, paper_doi, line)
+            if manifest:
+                # Rows are recorded as processed only once they are written
+                bulk.flush()
+                manifest.record_file(stage, journal_file_name)
+                manifest.save()
+    logging.info(f"Updated the ids of the authors of {bulk.totals['modified']} papers")
 
 
 def remove_pubmed_id_prefix():
     db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
     papers_db = db_papers.search({})
-    for paper_db in papers_db:
-        paper_doi = paper_db['DOI']
-        if '.0' in paper_db['pubmed_id']:
-            pubmed_id = paper_db['pubmed_id'].split('.')[0]
-        else:
-            pubmed_id = paper_db['pubmed_id']
-        logging.info(f"Processing paper {paper_doi}")
-        db_papers.update_record({'DOI': paper_doi}, {'pubmed_id': pubmed_id})
+    with db_papers.bulk_writer() as bulk:
+        for paper_db in papers_db:
+            paper_doi = paper_db['DOI']
+            if '.0' in paper_db['pubmed_id']:
+                pubmed_id = paper_db['pubmed_id'].split('.')[0]
+            else:
+                pubmed_id = paper_db['pubmed_id']
+            logging.info(f"Processing paper {paper_doi}")
+            bulk.update({'DOI': paper_doi}, {'pubmed_id': pubmed_id})
 
 
 def identify_duplicate_pubmed_ids():
@@ -894,8 +1087,7 @@ def identify_duplicate_pubmed_ids():
 
 def check_data_consistency():
     db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
-    papers_db = db_papers.search({})
-    papers = [paper_db for paper_db in papers_db]
+    papers = db_papers.search({}, {'pubmed_id': 1}, stream=True)
     total_papers, with_pmid, without_pmid, others = 0, 0, 0, 0
     for paper in papers:
         total_papers += 1
@@ -906,7 +1098,7 @@ def check_data_consistency():
         else:
             others += 1
     logging.info(f"Total papers (counter): {total_papers}")
-    logging.info(f"Total papers (len): {len(papers)}")
+    logging.info(f"Total papers (db): {db_papers.num_records({})}")
     logging.info(f"With Pubmed Id: {with_pmid}")
     logging.info(f"Without Pubmed Id: {without_pmid}")
     logging.info(f"Other: {others}")
@@ -950,48 +1142,46 @@ def check_consistency_between_author_id_and_author_record():
     for file_name in file_names:
         logging.info(f"\nProcessing: {file_name}")
         journal_file_name = dir_summary.joinpath(file_name)
-        with open(str(journal_file_name), 'r', encoding='utf-8') as f:
-            file = csv.DictReader(f, delimiter=',')
-            for line in file:
-                paper_db = db_papers.find_record({'DOI': line['DOI']})
-                if paper_db:
-                    paper_counter += 1
-                    logging.info(f"[{paper_counter}] Processing paper: {paper_db['DOI']}")
-                    author_ids_db = paper_db['authors_id']
-                    author_ids_file = [author_id.strip() for author_id in line['Author(s) ID'].split(';')]
-                    _, _, paper_full = obtain_paper_abstract_and_pubmedid(file_name, line['EID'])
-                    authors_last_name = [aff.split(',')[0] for aff in paper_full['Authors with affiliations'].split(';')]
-                    authors_file = {}
-                    for index, author_id_file in enumerate(author_ids_file):
-                        authors_file[author_id_file] = authors_last_name[index].strip()
-                    found_inconsistency, update_author_ids_paper = False, False
-                    for author_id_file in author_ids_file:
-                        if author_id_file in author_ids_db:
-                            author_db = db_authors.find_record({'id': author_id_file})
-                            last_name_author_db = normalize_text(curate_author_name(author_db['last_name']))
-                            last_name_author_file = normalize_text(curate_author_name(authors_file[author_id_file]))
-                            if last_name_author_db.lower() != last_name_author_file.lower():
-                                logging.info(f"Found inconsistency in author {author_id_file}. \n"
-                                             f"Last name: {last_name_author_db} (DB) - {last_name_author_file} (File).\n"
-                                             f"Corrective actions will be taken.")
-                                found_inconsistency = True
-                                inconsistent_authors += 1
-                                db_authors.update_record({'id': author_id_file},
-                                                         {'last_name': last_name_author_file,
-                                                          'name': '',
-                                                          'gender': ''})
-                                db_authors.remove_field_from_record({'id': author_id_file},
-                                                                    {'first_name': 1})
-                        else:
+        for line in iter_scopus_records(journal_file_name):
+            paper_db = db_papers.find_record({'DOI': line['DOI']})
+            if paper_db:
+                paper_counter += 1
+                logging.info(f"[{paper_counter}] Processing paper: {paper_db['DOI']}")
+                author_ids_db = paper_db['authors_id']
+                author_ids_file = line['author_ids']
+                _, _, paper_full = obtain_paper_abstract_and_pubmedid(file_name, line['EID'])
+                authors_last_name = [aff.split(',')[0] for aff in paper_full['Authors with affiliations'].split(';')]
+                authors_file = {}
+                for index, author_id_file in enumerate(author_ids_file):
+                    authors_file[author_id_file] = authors_last_name[index].strip()
+                found_inconsistency, update_author_ids_paper = False, False
+                for author_id_file in author_ids_file:
+                    if author_id_file in author_ids_db:
+                        author_db = db_authors.find_record({'id': author_id_file})
+                        last_name_author_db = normalize_text(curate_author_name(author_db['last_name']))
+                        last_name_author_file = normalize_text(curate_author_name(authors_file[author_id_file]))
+                        if last_name_author_db.lower() != last_name_author_file.lower():
+                            logging.info(f"Found inconsistency in author {author_id_file}. \n"
+                                         f"Last name: {last_name_author_db} (DB) - {last_name_author_file} (File).\n"
+                                         f"Corrective actions will be taken.")
                             found_inconsistency = True
-                            update_author_ids_paper = True
-                    if found_inconsistency or update_author_ids_paper:
-                        inconsistent_papers += 1
-                        logging.info(f"The lists of author names and genders will be removed for the paper {paper_db['DOI']}")
-                        db_papers.remove_field_from_record({'DOI': paper_db['DOI']},
-                                                           {'authors': 1, 'authors_gender': 1})
-                        if update_author_ids_paper:
-                            db_papers.update_record({'DOI': paper_db['DOI']}, {'authors_id': author_ids_file})
+                            inconsistent_authors += 1
+                            db_authors.update_record({'id': author_id_file},
+                                                     {'last_name': last_name_author_file,
+                                                      'name': '',
+                                                      'gender': ''})
+                            db_authors.remove_field_from_record({'id': author_id_file},
+                                                                {'first_name': 1})
+                    else:
+                        found_inconsistency = True
+                        update_author_ids_paper = True
+                if found_inconsistency or update_author_ids_paper:
+                    inconsistent_papers += 1
+                    logging.info(f"The lists of author names and genders will be removed for the paper {paper_db['DOI']}")
+                    db_papers.remove_field_from_record({'DOI': paper_db['DOI']},
+                                                       {'authors': 1, 'authors_gender': 1})
+                    if update_author_ids_paper:
+                        db_papers.update_record({'DOI': paper_db['DOI']}, {'authors_id': author_ids_file})
     logging.info(f"Inconsistencies: \n\tPapers: {inconsistent_papers}\n\tAuthors: {inconsistent_authors}")
 
 
@@ -1012,24 +1202,29 @@ def standardize_genders():
 def fix_inconsistencies_paper_authors():
     db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
     db_authors = DBManager('bioinfo_authors', db_name=get_db_name())
-    papers_db = db_papers.search({})
-    papers = [paper_db for paper_db in papers_db]
-    for paper in papers:
-        if 'authors_id' in paper:
-            authors_name = []
-            authors_gender = []
-            authors_id = []
-            for author_id in paper['authors_id']:
-                author_db = db_authors.find_record({'id': author_id})
-                if author_db:
-                    authors_id.append(author_id)
-                    authors_name.append(author_db['name'])
-                    authors_gender.append(author_db['gender'])
-            db_papers.update_record({'DOI': paper['DOI']},
-                                    {'authors_id': authors_id,
-                                     'authors': authors_name,
-                                     'authors_gender': authors_gender})
-            logging.info(f"Updated paper: {paper['DOI']}")
+    paper_chunks = db_papers.search_in_chunks({'authors_id': {'$exists': 1}}, {'DOI': 1, 'authors_id': 1})
+    with db_papers.bulk_writer() as bulk:
+        for papers in paper_chunks:
+            # Get the authors of the whole chunk of papers in one query
+            chunk_author_ids = list({author_id for paper in papers for author_id in paper['authors_id']})
+            authors_db = db_authors.search({'id': {'$in': chunk_author_ids}}, {'id': 1, 'name': 1, 'gender': 1},
+                                           stream=True)
+            authors = {author_db['id']: author_db for author_db in authors_db}
+            for paper in papers:
+                authors_name = []
+                authors_gender = []
+                authors_id = []
+                for author_id in paper['authors_id']:
+                    author_db = authors.get(author_id)
+                    if author_db:
+                        authors_id.append(author_id)
+                        authors_name.append(author_db['name'])
+                        authors_gender.append(author_db['gender'])
+                bulk.update({'DOI': paper['DOI']},
+                            {'authors_id': authors_id,
+                             'authors': authors_name,
+                             'authors_gender': authors_gender})
+                logging.info(f"Updated paper: {paper['DOI']}")
 
 
 def add_authors_info_to_papers():
@@ -1,86 +1,481 @@
-
-from pymongo import MongoClient
-from utils import get_config
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient, ReturnDocument, UpdateOne
+from pymongo.cursor import Cursor
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from db_profiler import profiled, profiler
+from utils import get_project_config
 
 import logging
+import os
 import pathlib
+import threading
+import time
 
 logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
                     level=logging.DEBUG)
 
 
+# Default settings of the connection pool, they can be
+# overridden through the dictionary mongo of config.json
+POOL_DEFAULTS = {
+    'max_pool_size': 50,
+    'min_pool_size': 0,
+    'connect_timeout_ms': 20000,
+    'server_selection_timeout_ms': 30000,
+    'socket_timeout_ms': None
+}
+
+# Indexes that each collection is expected to have. Every entry
+# is a tuple (name, keys, options) that is passed to IndexModel
+INDEXES = {
+    'bioinfo_papers': [
+        ('doi_unique', [('DOI', ASCENDING)], {'unique': True}),
+        ('pubmed_id', [('pubmed_id', ASCENDING)], {}),
+        ('e_id', [('e_id', ASCENDING)], {}),
+        ('link', [('link', ASCENDING)], {}),
+        ('authors_id', [('authors_id', ASCENDING)], {}),
+        ('updated_at', [('updated_at', ASCENDING)], {})
+    ],
+    'bioinfo_authors': [
+        # Authors created from PubMed do not have the Scopus id
+        ('id_unique', [('id', ASCENDING)], {'unique': True, 'partialFilterExpression': {'id': {'$type': 'string'}}}),
+        ('name', [('name', ASCENDING)], {}),
+        ('other_names', [('other_names', ASCENDING)], {}),
+        ('dois', [('dois', ASCENDING)], {}),
+        ('updated_at', [('updated_at', ASCENDING)], {})
+    ],
+    'bioinfo_affiliations': [
+        ('name_unique', [('name', ASCENDING)], {'unique': True})
+    ]
+}
+
+
+# Registry of clients shared by all the instances of DBManager,
+# one pooled client per host and port. Clients cannot be shared
+# between processes, so each process gets its own
+_clients = dict()
+_clients_lock = threading.Lock()
+
+
+def get_client(host, port):
+    key = (host, str(port), os.getpid())
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            mongo_config = get_project_config()['mongo']
+            pool_config = {option: mongo_config.get(option, default) for option, default in POOL_DEFAULTS.items()}
+            client = MongoClient(host + ':' + str(port),
+                                 maxPoolSize=pool_config['max_pool_size'],
+                                 minPoolSize=pool_config['min_pool_size'],
+                                 connectTimeoutMS=pool_config['connect_timeout_ms'],
+                                 serverSelectionTimeoutMS=pool_config['server_selection_timeout_ms'],
+                                 socketTimeoutMS=pool_config['socket_timeout_ms'])
+            logging.info(f"Created client to the database server {key[0]}:{key[1]} ({pool_config})")
+            _clients[key] = client
+        return client
+
+
+def close_clients():
+    with _clients_lock:
+        for (_, _, pid), client in list(_clients.items()):
+            if pid == os.getpid():
+                client.close()
+        _clients.clear()
+
+
+def create_indexes(db_name=''):
+    for collection in INDEXES.keys():
+        DBManager(collection, db_name=db_name).create_indexes()
+
+
+def report_index_usage(db_name=''):
+    return {collection: DBManager(collection, db_name=db_name).get_index_report() for collection in INDEXES.keys()}
+
+
+# Every write done through DBManager records when the record changed
+# in this field, so that exports can emit only the changed records.
+# The time is always taken from the clock of the database server
+UPDATED_AT_FIELD = 'updated_at'
+
+
+def track_update(update):
+    current_date = dict(update.get('$currentDate', {}), **{UPDATED_AT_FIELD: True})
+    return dict(update, **{'$currentDate': current_date})
+
+
+def track_insert(record):
+    """
+    Turn the insertion of the record into an upsert on a new _id, so that
+    the server sets the update time of the record
+    :return: tuple (filter, update) of the upsert
+    """
+    record_id = record.get('_id') or ObjectId()
+    values_to_insert = {key: value for key, value in record.items() if key != '_id'}
+    return {'_id': record_id}, track_update({'$setOnInsert': values_to_insert})
+
+
+def changed_values_query(filter_query, new_values):
+    # Match only the records where some of the values differ, so that records
+    # whose values don't change are not written and keep their update time
+    if not new_values:
+        return filter_query
+    changed_values = []
+    for field, value in new_values.items():
+        changed_values.append({field: {'$ne': value}})
+        if value is None:
+            # $ne: null doesn't match the records that lack the field
+            changed_values.append({field: {'$exists': False}})
+    return {'$and': [filter_query, {'$or': changed_values}]}
+
+
+def existing_fields_query(filter_query, fields):
+    # Match only the records that have some of the fields
+    return {'$and': [filter_query, {'$or': [{field: {'$exists': True}} for field in fields]}]}
+
+
+###
+# Class to buffer write operations and send them to
+# the database in unordered batches
+###
+class BulkWriter:
+    __collection = None
+    __operations = None
+
+    def __init__(self, collection, batch_size=1000):
+        self.__collection = collection
+        self.__operations = []
+        self.batch_size = batch_size
+        self.num_flushes = 0
+        self.totals = {'inserted': 0, 'matched': 0, 'modified': 0, 'upserted': 0, 'duplicates': 0, 'errors': 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+    def add(self, operation):
+        self.__operations.append(operation)
+        if len(self.__operations) >= self.batch_size:
+            self.flush()
+
+    def insert(self, record_to_save):
+        self.add(UpdateOne(*track_insert(record_to_save), upsert=True))
+
+    def update(self, filter_query, new_values, create_if_doesnt_exist=False):
+        if not create_if_doesnt_exist:
+            # An upsert cannot be guarded, it would insert a copy of an unchanged record
+            filter_query = changed_values_query(filter_query, new_values)
+        self.add(UpdateOne(filter_query, track_update({'$set': new_values}), upsert=create_if_doesnt_exist))
+
+    def upsert(self, filter_query, new_values):
+        self.update(filter_query, new_values, create_if_doesnt_exist=True)
+
+    def store(self, filter_query, record_to_store):
+        # Insert the record only if there isn't any other matching the query
+        # The update time is set after the flush, only on the inserted records
+        self.add(UpdateOne(filter_query, {'$setOnInsert': record_to_store}, upsert=True))
+
+    def flush(self):
+        if not self.__operations:
+            return None
+        operations, self.__operations = self.__operations, []
+        self.num_flushes += 1
+        start = time.perf_counter()
+        try:
+            result = self.__collection.bulk_write(operations, ordered=False)
+            report = {
+                'inserted': result.inserted_count,
+                'matched': result.matched_count,
+                'modified': result.modified_count,
+                'upserted': result.upserted_count,
+                'duplicates': 0,
+                'errors': 0
+            }
+            upserted_ids = list(result.upserted_ids.values())
+        except BulkWriteError as bwe:
+            details = bwe.details
+            write_errors = details.get('writeErrors', [])
+            # Duplicate key errors (code 11000) are raised by unique indexes
+            # and are reported as duplicates rather than as errors
+            duplicate_errors = [write_error for write_error in write_errors if write_error.get('code') == 11000]
+            report = {
+                'inserted': details.get('nInserted', 0),
+                'matched': details.get('nMatched', 0),
+                'modified': details.get('nModified', 0),
+                'upserted': details.get('nUpserted', 0),
+                'duplicates': len(duplicate_errors),
+                'errors': len(write_errors) - len(duplicate_errors)
+            }
+            upserted_ids = [upserted['_id'] for upserted in details.get('upserted', [])]
+            for write_error in write_errors:
+                if write_error.get('code') != 11000:
+                    logging.error(f"Error in the bulk write operation {write_error.get('index')}: "
+                                  f"{write_error.get('errmsg')}")
+        if upserted_ids:
+            # Records inserted by store don't have an update time yet
+            self.__collection.update_many({'_id': {'$in': upserted_ids}, UPDATED_AT_FIELD: {'$exists': False}},
+                                          {'$currentDate': {UPDATED_AT_FIELD: True}})
+        if profiler.enabled:
+            profiler.record(self.__collection.name, 'bulk_write', (time.perf_counter() - start) * 1000, len(operations))
+        for key, value in report.items():
+            self.totals[key] += value
+        logging.info(f"[{self.__collection.name}] Flush {self.num_flushes}, {len(operations)} operations: {report}")
+        return report
+
+
+###
+# Cursor of the searches that are not streamed. find is lazy, so the
+# cursor times the fetching of its records and reports it to the
+# profiler once it is exhausted or closed. It is still a regular
+# pymongo cursor (count, sort, limit, etc.)
+###
+class ProfiledCursor(Cursor):
+
+    def __init__(self, collection, filter=None, *args, **kwargs):
+        super().__init__(collection, filter, *args, **kwargs)
+        self.__query = filter
+        self.__recorded = False
+        self.fetch_ms = 0.0
+        self.num_docs = 0
+
+    def next(self):
+        start = time.perf_counter()
+        try:
+            record = super().next()
+        except StopIteration:
+            self.fetch_ms += (time.perf_counter() - start) * 1000
+            self.__record()
+            raise
+        self.fetch_ms += (time.perf_counter() - start) * 1000
+        self.num_docs += 1
+        return record
+
+    __next__ = next
+
+    def close(self):
+        super().close()
+        self.__record()
+
+    def __record(self):
+        if self.__recorded:
+            return
+        self.__recorded = True
+        if profiler.enabled:
+            profiler.record(self.collection.name, 'search', self.fetch_ms, self.num_docs, self.__query)
+
+
 class DBManager:
     __db = None
     __host = None
     __collection = ''
+    __coll = None
 
     def __init__(self, collection, db_name=''):
-        current_dir = pathlib.Path(__file__).parents[0]
-        config_fn = current_dir.joinpath('config.json')
-        config = get_config(config_fn)
+        config = get_project_config()
         self.__host = config['mongo']['host']
         self.__port = config['mongo']['port']
-        client = MongoClient(self.__host + ':' + self.__port)
+        client = get_client(self.__host, self.__port)
 
         if not db_name:
             self.__db = client[config['mongo']['db_name']]
         else:
             self.__db = client[db_name]
         self.__collection = collection
+        self.__coll = self.__db[collection]
+
+    @property
+    def collection_name(self):
+        return self.__collection
+
+    @property
+    def db_name(self):
+        return self.__db.name
 
+    @profiled
     def num_records(self, query):
-        return self.__db[self.__collection].count_documents(query)
+        return self.__coll.count_documents(query)
 
+    @profiled
     def save_record(self, record_to_save):
-        self.__db[self.__collection].insert(record_to_save)
+        self.__coll.update_one(*track_insert(record_to_save), upsert=True)
+
+    def create_indexes(self):
+        index_specs = INDEXES.get(self.__collection, [])
+        created_indexes = []
+        for index_name, index_keys, index_options in index_specs:
+            try:
+                self.__coll.create_indexes([IndexModel(index_keys, name=index_name, **index_options)])
+                created_indexes.append(index_name)
+            except OperationFailure as e:
+                logging.error(f"[{self.__collection}] Could not create the index {index_name}: {e}")
+                # Writes rely on unique indexes to avoid duplicates, so they must exist
+                if index_options.get('unique'):
+                    raise
+        logging.info(f"[{self.__collection}] Ensured indexes: {created_indexes}")
+        return created_indexes
+
+    def get_index_report(self):
+        existing_indexes = self.__coll.index_information()
+        index_usage = {index_stats['name']: index_stats['accesses']['ops']
+                       for index_stats in self.__coll.aggregate([{'$indexStats': {}}])}
+        report = {'missing': [], 'unused': [], 'usage': index_usage}
+        for index_name, _, _ in INDEXES.get(self.__collection, []):
+            if index_name not in existing_indexes:
+                report['missing'].append(index_name)
+                logging.warning(f"[{self.__collection}] Missing index {index_name}, queries on it will "
+                                f"scan the whole collection")
+        for index_name, num_ops in index_usage.items():
+            if index_name != '_id_' and num_ops == 0:
+                report['unused'].append(index_name)
+        logging.info(f"[{self.__collection}] Index usage: {index_usage}")
+        return report
 
-    def find_record(self, query):
-        return self.__db[self.__collection].find_one(query)
+    def bulk_writer(self, batch_size=1000):
+        return BulkWriter(self.__coll, batch_size)
 
+    @profiled
+    def find_record(self, query, return_fields=None):
+        return self.__coll.find_one(query, return_fields)
+
+    @profiled
     def update_record(self, filter_query, new_values, create_if_doesnt_exist=False):
-        return self.__db[self.__collection].update_one(filter_query, {'$set': new_values},
-                                                       upsert=create_if_doesnt_exist)
+        if not create_if_doesnt_exist:
+            filter_query = changed_values_query(filter_query, new_values)
+        return self.__coll.update_one(filter_query, track_update({'$set': new_values}),
+                                      upsert=create_if_doesnt_exist)
+
+    @profiled
+    def find_and_modify_record(self, filter_query, update, create_if_doesnt_exist=False, return_fields=None):
+        # Apply the update operators atomically and return the record as it
+        # was before the update, None if no record matched the filter
+        return self.__coll.find_one_and_update(filter_query, track_update(update),
+                                               projection=return_fields or {'_id': 1},
+                                               upsert=create_if_doesnt_exist,
+                                               return_document=ReturnDocument.BEFORE)
 
+    @profiled
     def update_records(self, filter_query, new_values):
-        return self.__db[self.__collection].update_many(filter_query, {'$set': new_values})
+        return self.__coll.update_many(changed_values_query(filter_query, new_values),
+                                       track_update({'$set': new_values}))
 
+    @profiled
     def update_all_records(self, new_values):
-        return self.__db[self.__collection].update_many({}, {'$set': new_values})
+        return self.__coll.update_many(changed_values_query({}, new_values), track_update({'$set': new_values}))
 
+    @profiled
     def remove_field_from_record(self, filter_query, fields_to_remove):
-        return self.__db[self.__collection].update_one(filter_query, {'$unset': fields_to_remove})
+        return self.__coll.update_one(existing_fields_query(filter_query, fields_to_remove),
+                                      track_update({'$unset': fields_to_remove}))
 
+    @profiled
     def remove_field_from_all_records(self, fields_to_remove):
-        return self.__db[self.__collection].update_many({}, {'$unset': fields_to_remove})
+        return self.__coll.update_many(existing_fields_query({}, fields_to_remove),
+                                       track_update({'$unset': fields_to_remove}))
 
+    @profiled
     def remove_record(self, filter_query):
-        return self.__db[self.__collection].remove(filter_query)
+        return self.__coll.remove(filter_query)
+
+    def search(self, query, return_fields=None, stream=False, batch_size=500):
+        # find is lazy, so searches are timed while their records are fetched
+        if stream:
+            return self.__stream_records(query, return_fields, batch_size)
+        return ProfiledCursor(self.__coll, query, return_fields or None, no_cursor_timeout=True)
 
-    def search(self, query, return_fields=None):
+    def __stream_records(self, query, return_fields, batch_size):
+        # Streamed searches must say which fields they need, so
+        # that large fields (e.g., abstracts) are not transferred
         if not return_fields:
-            return self.__db[self.__collection].find(query, no_cursor_timeout=True)
-        else:
-            return self.__db[self.__collection].find(query, return_fields, no_cursor_timeout=True)
+            raise ValueError('A projection (return_fields) is required to stream records')
+        cursor = self.__coll.find(query, return_fields, no_cursor_timeout=True, batch_size=batch_size)
+        return self.__stream_cursor(cursor, 'search_stream', query)
 
-    def store_record(self, record_to_store):
+    def __stream_cursor(self, cursor, method, query):
+        fetch_ms, num_docs = 0.0, 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    record = next(cursor)
+                except StopIteration:
+                    break
+                finally:
+                    fetch_ms += (time.perf_counter() - start) * 1000
+                num_docs += 1
+                yield record
+        finally:
+            # Close the cursor even if the caller stops iterating early
+            cursor.close()
+            if profiler.enabled:
+                profiler.record(self.__collection, method, fetch_ms, num_docs, query)
+
+    def search_in_chunks(self, query, return_fields, chunk_size=500):
+        chunk = []
+        for record in self.__stream_records(query, return_fields, chunk_size):
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def __get_record_query(self, record_to_store):
         if 'DOI' in record_to_store:
-            record_identifier = record_to_store['DOI']
-            query = {'DOI': record_identifier}
+            query = {'DOI': record_to_store['DOI']}
         elif 'name' in record_to_store:
-            record_identifier = record_to_store['name']
-            query = {'name': record_identifier}
+            query = {'name': record_to_store['name']}
         else:
-            record_identifier = record_to_store['id']
-            query = {'id': record_identifier}
-        num_results = self.search(query).count()
-        if num_results == 0:
-            self.save_record(record_to_store)
+            query = {'id': record_to_store['id']}
+        # The fields of the query are copied into the new
+        # document by the upsert
+        values_to_insert = {key: value for key, value in record_to_store.items() if key not in query}
+        return query, values_to_insert or query
+
+    @profiled
+    def insert_record_if_missing(self, filter_query, record_to_insert):
+        """
+        Insert the record in a single upsert only if there isn't any record
+        matching the query, records that match are left untouched. Raises
+        DuplicateKeyError if another writer inserts the record at the same time
+        :return: whether the record was inserted
+        """
+        result = self.__coll.update_one(filter_query, {'$setOnInsert': record_to_insert}, upsert=True)
+        if result.upserted_id is None:
+            return False
+        self.__coll.update_one({'_id': result.upserted_id}, track_update({}))
+        return True
+
+    def store_record(self, record_to_store):
+        query, values_to_insert = self.__get_record_query(record_to_store)
+        record_identifier = list(query.values())[0]
+        try:
+            inserted = self.insert_record_if_missing(query, values_to_insert)
+        except DuplicateKeyError:
+            # Another writer inserted the same record at the same time
+            inserted = False
+        if inserted:
             logging.info(f"Inserted record identified by: {record_identifier}")
             return True
         else:
             logging.info(f"Found record duplicated. Identifier: {record_identifier}")
             return False
 
+    def store_records(self, records_to_store, batch_size=1000):
+        num_records = 0
+        with self.bulk_writer(batch_size) as bulk:
+            for record_to_store in records_to_store:
+                num_records += 1
+                bulk.store(*self.__get_record_query(record_to_store))
+        report = {
+            'inserted': bulk.totals['upserted'],
+            'duplicates': num_records - bulk.totals['upserted'] - bulk.totals['errors'],
+            'errors': bulk.totals['errors']
+        }
+        logging.info(f"[{self.__collection}] Stored {num_records} records: {report}")
+        return report
+
     def get_papers_by_year(self):
         group = {
             '_id': '$year',
@@ -129,6 +524,62 @@ class DBManager:
         result_docs = self.aggregate(pipeline)
         return result_docs
 
+    def get_last_update_time(self):
+        record = self.__coll.find_one({UPDATED_AT_FIELD: {'$exists': True}}, {UPDATED_AT_FIELD: 1},
+                                      sort=[(UPDATED_AT_FIELD, DESCENDING)])
+        return record[UPDATED_AT_FIELD] if record else None
+
+    def get_id_ranges(self, num_ranges, query=None):
+        """
+        Split the records that match the query into ranges of _id of about
+        the same number of records
+        :return: list of queries, one per range, on the _id of records
+        """
+        pipeline = [
+            {'$match': query or {}},
+            {'$project': {'_id': 1}},
+            {'$bucketAuto': {'groupBy': '$_id', 'buckets': num_ranges}}
+        ]
+        buckets = self.aggregate(pipeline)
+        id_ranges = []
+        for idx, bucket in enumerate(buckets):
+            # The upper bound is exclusive except in the last bucket
+            upper_operator = '$lte' if idx == len(buckets) - 1 else '$lt'
+            id_ranges.append({'_id': {'$gte': bucket['_id']['min'], upper_operator: bucket['_id']['max']}})
+        return id_ranges
+
+    def get_cube_slice(self, filters=None, dimensions=None, measures=('authorships', 'citations')):
+        """
+        Read a slice of the analytics cube (see analytics_cube.py), this
+        DBManager must be created for the collection of the cube
+        :param filters: dictionary with the values of the dimensions to keep, a value can also be a list of values
+        :param dimensions: dimensions by which the measures are summed up, if empty the slice is totalized
+        :return: list of dictionaries with the dimensions and the sum of the measures
+        """
+        match = {dimension: {'$in': value} if isinstance(value, (list, tuple)) else value
+                 for dimension, value in (filters or {}).items()}
+        group = {
+            '_id': {dimension: f"${dimension}" for dimension in dimensions or []}
+        }
+        group.update({measure: {'$sum': f"${measure}"} for measure in measures})
+        project = {dimension: f"$_id.{dimension}" for dimension in dimensions or []}
+        project.update({measure: 1 for measure in measures})
+        project['_id'] = 0
+        sort = {f"_id.{dimension}": 1 for dimension in dimensions or []} or {'_id': 1}
+        pipeline = [
+            {'$match': match},
+            {'$group': group},
+            {'$sort': sort},
+            {'$project': project}
+        ]
+        result_docs = self.aggregate(pipeline)
+        return result_docs
+
+    def get_gender_counts_by_year(self, position=None):
+        # Authorships by year and gender, optionally only of the given position (first, middle, last, or single)
+        filters = {'position': position} if position else {}
+        return self.get_cube_slice(filters, ['year', 'gender'], measures=('authorships',))
+
     def get_name_authors_without_del_flag(self):
         match = {
             'delete': {
@@ -146,5 +597,12 @@ class DBManager:
         result_docs = self.aggregate(pipeline)
         return result_docs
 
+    @profiled
     def aggregate(self, pipeline):
-        return [doc for doc in self.__db[self.__collection].aggregate(pipeline, allowDiskUse=True)]
+        return [doc for doc in self.__coll.aggregate(pipeline, allowDiskUse=True)]
+
+    def aggregate_stream(self, pipeline, batch_size=1000):
+        # Return the results of the pipeline as they are fetched from the
+        # database, in batches of batch_size, instead of all at once
+        cursor = self.__coll.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+        return self.__stream_cursor(cursor, 'aggregate_stream', pipeline)
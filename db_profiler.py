@@ -0,0 +1,125 @@
+import bisect
+import functools
+import logging
+import pathlib
+import threading
+import time
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+# Upper bounds (in milliseconds) of the buckets of the latency histograms
+LATENCY_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000, float('inf')]
+
+
+def get_query_shape(query):
+    # Replace the values of the query by their types so that
+    # operations that differ only in their values are grouped
+    if isinstance(query, dict):
+        return {key: get_query_shape(value) for key, value in query.items()}
+    if isinstance(query, (list, tuple)):
+        return [get_query_shape(value) for value in query[:1]]
+    return type(query).__name__
+
+
+def count_returned_docs(result):
+    if result is None:
+        return 0
+    if isinstance(result, dict):
+        return 1
+    if isinstance(result, list):
+        return len(result)
+    return None
+
+
+###
+# Class to collect per collection and per method statistics
+# of the operations done through DBManager
+###
+class DBProfiler:
+    __stats = None
+    __slow_operations = None
+    __lock = None
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_operation_ms = 200
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def enable(self, slow_operation_ms=200):
+        self.enabled = True
+        self.slow_operation_ms = slow_operation_ms
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.__stats = dict()
+        self.__slow_operations = []
+
+    def record(self, collection, method, elapsed_ms, num_docs=None, query=None):
+        with self.__lock:
+            key = (collection, method)
+            if key not in self.__stats:
+                self.__stats[key] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'docs': 0,
+                                     'histogram': [0] * len(LATENCY_BUCKETS_MS)}
+            op_stats = self.__stats[key]
+            op_stats['count'] += 1
+            op_stats['total_ms'] += elapsed_ms
+            op_stats['max_ms'] = max(op_stats['max_ms'], elapsed_ms)
+            if num_docs:
+                op_stats['docs'] += num_docs
+            op_stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            if elapsed_ms >= self.slow_operation_ms:
+                slow_operation = {'collection': collection, 'method': method, 'elapsed_ms': round(elapsed_ms, 2),
+                                  'query_shape': get_query_shape(query)}
+                self.__slow_operations.append(slow_operation)
+                logging.warning(f"Slow database operation: {slow_operation}")
+
+    def get_summary(self):
+        with self.__lock:
+            summary = []
+            for (collection, method), op_stats in sorted(self.__stats.items(),
+                                                         key=lambda item: item[1]['total_ms'], reverse=True):
+                summary.append({
+                    'collection': collection,
+                    'method': method,
+                    'count': op_stats['count'],
+                    'total_ms': round(op_stats['total_ms'], 2),
+                    'avg_ms': round(op_stats['total_ms'] / op_stats['count'], 2),
+                    'max_ms': round(op_stats['max_ms'], 2),
+                    'docs': op_stats['docs'],
+                    'histogram': dict(zip([f"<={bound}ms" for bound in LATENCY_BUCKETS_MS], op_stats['histogram']))
+                })
+            return summary
+
+    def dump_summary(self, stage, reset=True):
+        if not self.enabled:
+            return None
+        summary = self.get_summary()
+        logging.info(f"Database operations of the stage '{stage}' "
+                     f"({len(self.__slow_operations)} slow operations):")
+        for op_summary in summary:
+            logging.info(f"\t{op_summary}")
+        if reset:
+            self.reset()
+        return summary
+
+
+profiler = DBProfiler()
+
+
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not profiler.enabled:
+            return func(self, *args, **kwargs)
+        start = time.perf_counter()
+        result = func(self, *args, **kwargs)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        query = args[0] if args else None
+        profiler.record(self.collection_name, func.__name__, elapsed_ms, count_returned_docs(result), query)
+        return result
+    return wrapper
@@ -0,0 +1,140 @@
+import functools
+import json
+import logging
+import os
+import pandas as pd
+import pathlib
+import pyarrow.parquet as pq
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+INDEX_VERSION = 2
+
+# Columns of the processed files used when loading the papers
+PAPER_COLUMNS = ['EID', 'Abstract', 'PubMed ID', 'Authors with affiliations', 'Affiliations', 'Cited by']
+
+# Indexes already loaded by the current process, by journal file name
+_loaded_indexes = dict()
+
+
+def get_processed_file_path(file_name):
+    # Journals are combined by combine_csv_files into Parquet files
+    return pathlib.Path('data', 'processed').joinpath(pathlib.Path(file_name).stem + '.parquet')
+
+
+def get_index_file_path(file_name):
+    return pathlib.Path('data', 'processed').joinpath(f".{file_name}.eid_index.json")
+
+
+def read_processed_journal(journal_name, columns=None):
+    """
+    Read the combined file of a journal loading only the given columns
+    """
+    dir_processed = pathlib.Path('data', 'processed')
+    parquet_file = dir_processed.joinpath(journal_name + '.parquet')
+    if parquet_file.exists():
+        return pd.read_parquet(parquet_file, columns=columns)
+    else:
+        return pd.read_csv(dir_processed.joinpath(journal_name + '.csv'), usecols=columns, dtype=str,
+                           keep_default_na=False)
+
+
+def parse_pubmed_id(raw_pubmed_id):
+    if '.0' in raw_pubmed_id:
+        return raw_pubmed_id.split('.')[0]
+    else:
+        return raw_pubmed_id
+
+
+def __get_file_signature(journal_file_name):
+    file_stat = os.stat(str(journal_file_name))
+    return {'mtime': file_stat.st_mtime, 'size': file_stat.st_size}
+
+
+def build_eid_index(file_name):
+    """
+    Read the EIDs and PubMed IDs of a processed journal file and record,
+    for every EID, the number of its row in the file and its PubMed ID
+    """
+    journal_file_name = get_processed_file_path(file_name)
+    # Taken before reading the file, so that changes made meanwhile trigger a new build
+    signature = __get_file_signature(journal_file_name)
+    papers = read_processed_journal(journal_file_name.stem, columns=['EID', 'PubMed ID'])
+    index = dict()
+    for row_number, (paper_eid, pubmed_id) in enumerate(zip(papers['EID'], papers['PubMed ID'])):
+        if paper_eid not in index:
+            index[paper_eid] = [row_number, parse_pubmed_id(pubmed_id)]
+    metadata = pq.ParquetFile(str(journal_file_name)).metadata
+    eid_index = {
+        'version': INDEX_VERSION,
+        'signature': signature,
+        'row_groups': [metadata.row_group(row_group).num_rows for row_group in range(metadata.num_row_groups)],
+        'index': index
+    }
+    index_file_name = get_index_file_path(file_name)
+    tmp_index_file_name = index_file_name.with_name(f"{index_file_name.name}.{os.getpid()}.tmp")
+    with open(str(tmp_index_file_name), 'w', encoding='utf-8') as f:
+        json.dump(eid_index, f)
+    # Replace the index atomically, other processes might be reading it
+    os.replace(str(tmp_index_file_name), str(index_file_name))
+    logging.info(f"Built the EID index of {file_name} ({len(index)} papers)")
+    return eid_index
+
+
+def __is_index_valid(eid_index, file_name):
+    return eid_index.get('version') == INDEX_VERSION and \
+           eid_index.get('signature') == __get_file_signature(get_processed_file_path(file_name))
+
+
+def load_eid_index(file_name):
+    eid_index = _loaded_indexes.get(file_name)
+    if eid_index and __is_index_valid(eid_index, file_name):
+        return eid_index
+    eid_index = None
+    index_file_name = get_index_file_path(file_name)
+    if index_file_name.exists():
+        try:
+            with open(str(index_file_name), 'r', encoding='utf-8') as f:
+                eid_index = json.load(f)
+        except ValueError:
+            logging.warning(f"The EID index of {file_name} is corrupted, it will be rebuilt")
+    if not eid_index or not __is_index_valid(eid_index, file_name):
+        eid_index = build_eid_index(file_name)
+    _loaded_indexes[file_name] = eid_index
+    return eid_index
+
+
+def get_pubmed_id(file_name, paper_eid):
+    entry = load_eid_index(file_name)['index'].get(paper_eid)
+    return entry[1] if entry else None
+
+
+# Consecutive lookups often fall in the same row groups, the last
+# row groups read are kept. The signature of the file is part of the
+# key, so that row groups of a file that changed are not reused
+@functools.lru_cache(maxsize=8)
+def _read_row_group(file_name, signature, row_group):
+    parquet_file = pq.ParquetFile(str(get_processed_file_path(file_name)))
+    columns = [column for column in PAPER_COLUMNS if column in parquet_file.schema.names]
+    return parquet_file.read_row_group(row_group, columns=columns).to_pydict()
+
+
+def find_paper_by_eid(file_name, paper_eid):
+    """
+    :return: dictionary with the columns in PAPER_COLUMNS of the paper, None if
+    the paper is not in the processed file
+    """
+    eid_index = load_eid_index(file_name)
+    entry = eid_index['index'].get(paper_eid)
+    if not entry:
+        return None
+    row_number = entry[0]
+    for row_group, num_rows in enumerate(eid_index['row_groups']):
+        if row_number < num_rows:
+            break
+        row_number -= num_rows
+    signature = eid_index['signature']
+    paper_columns = _read_row_group(file_name, (signature['mtime'], signature['size']), row_group)
+    return {column: values[row_number] for column, values in paper_columns.items()}
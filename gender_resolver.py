@@ -0,0 +1,180 @@
+from db_manager import DBManager
+from gender_table import load_gender_table
+from hammock import Hammock as GendreAPI
+from utils import get_db_name, get_project_config, normalize_text
+
+import functools
+import gender_guesser.detector as gender
+import logging
+import pathlib
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+GENDER_CACHE_COLLECTION = 'bioinfo_gender_cache'
+NAMSOR_URL = 'http://api.namsor.com/onomastics/api/json/gendre'
+
+# Genders returned by the services that are stored as other genders
+GENDER_MAPPING = {
+    'mostly_male': 'male',
+    'mostly_female': 'female',
+    'andy': 'unknown'
+}
+
+# Gender of names that could not be resolved because of an error of
+# the service, they are not cached so they are tried again later
+ERROR_GENDER = 'error_api'
+
+
+# The detector parses its whole name dictionary when it is
+# built, so it is built only once per process
+@functools.lru_cache(maxsize=None)
+def get_gender_detector():
+    return gender.Detector(case_sensitive=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_namsor_api():
+    return GendreAPI(NAMSOR_URL)
+
+
+def split_name(full_name):
+    name_parts = full_name.split()
+    if not name_parts:
+        return '', ''
+    return name_parts[0], name_parts[-1]
+
+
+def get_name_key(first_name, last_name):
+    # Names are cached regardless of their case and accents
+    return f"{normalize_text(first_name).lower()} {normalize_text(last_name).lower()}"
+
+
+def resolve_gender(first_name, last_name):
+    """
+    Ask namsor for the gender of the name, falling back to the
+    first-name dictionary of gender_guesser when namsor does not know it
+    """
+    try:
+        author_gender = get_namsor_api()(first_name, last_name).GET().json().get('gender')
+        if author_gender == 'unknown':
+            logging.info('Trying to get the author\'s gender using the second api')
+            # if the main api returns unknown gender, try with another api
+            author_gender = get_gender_detector().get_gender(first_name)
+        return GENDER_MAPPING.get(author_gender, author_gender)
+    except Exception as e:
+        logging.error(f"Error when getting the gender of {first_name} {last_name}: {e}")
+        return ERROR_GENDER
+
+
+###
+# Gender resolution with a cache of the genders already resolved,
+# kept in memory and in the collection bioinfo_gender_cache, whose
+# records have as _id the normalized first and last name. With a
+# gender table, names are first looked up offline in the table
+###
+class GenderResolver:
+
+    def __init__(self, db_name='', gender_table=None, remote_fallback=True):
+        """
+        :param gender_table: GenderTable where first names are looked up before the cache
+        :param remote_fallback: resolve the names not found in the table nor in the cache
+        with the remote services, otherwise their gender is unknown
+        """
+        self.db_cache = DBManager(GENDER_CACHE_COLLECTION, db_name=db_name or get_db_name())
+        self.gender_table = gender_table
+        self.remote_fallback = remote_fallback
+        self.__genders = dict()
+        self.stats = {'names': 0, 'memory_hits': 0, 'table_hits': 0, 'cache_hits': 0, 'misses': 0, 'errors': 0}
+
+    def __load_cached_genders(self, name_keys):
+        cached_genders = self.db_cache.search({'_id': {'$in': name_keys}}, {'gender': 1})
+        for cached_gender in cached_genders:
+            self.__genders[cached_gender['_id']] = cached_gender['gender']
+            self.stats['cache_hits'] += 1
+
+    def __look_up_gender_table(self, names_by_key, name_keys):
+        for name_key in name_keys:
+            table_gender = self.gender_table.get_gender(names_by_key[name_key][0])
+            table_gender = GENDER_MAPPING.get(table_gender, table_gender)
+            # Androgynous and unknown names are left to the other sources
+            if table_gender in ('female', 'male'):
+                self.__genders[name_key] = table_gender
+                self.stats['table_hits'] += 1
+
+    def get_genders(self, full_names):
+        """
+        Resolve the gender of several names at once. Names are deduplicated,
+        looked up in the gender table if there is one, the cache is queried
+        once for the rest, and only the names that are not cached are resolved
+        by the remote services
+        :param full_names: list of names in the form first name ... last name
+        :return: list with the gender of each name
+        """
+        names_by_key = dict()
+        for full_name in full_names:
+            first_name, last_name = split_name(full_name)
+            if first_name:
+                names_by_key.setdefault(get_name_key(first_name, last_name), (first_name, last_name))
+        self.stats['names'] += len(full_names)
+        pending_keys = [name_key for name_key in names_by_key.keys() if name_key not in self.__genders]
+        self.stats['memory_hits'] += len(names_by_key) - len(pending_keys)
+        if pending_keys and self.gender_table is not None:
+            self.__look_up_gender_table(names_by_key, pending_keys)
+            pending_keys = [name_key for name_key in pending_keys if name_key not in self.__genders]
+        if pending_keys:
+            self.__load_cached_genders(pending_keys)
+        with self.db_cache.bulk_writer() as writer:
+            for name_key in pending_keys:
+                if name_key in self.__genders:
+                    continue
+                if not self.remote_fallback:
+                    # Not cached, the name can still be resolved by a later remote lookup
+                    self.__genders[name_key] = 'unknown'
+                    continue
+                first_name, last_name = names_by_key[name_key]
+                author_gender = resolve_gender(first_name, last_name)
+                self.stats['misses'] += 1
+                if author_gender == ERROR_GENDER:
+                    self.stats['errors'] += 1
+                    continue
+                self.__genders[name_key] = author_gender
+                writer.store({'_id': name_key}, {'_id': name_key, 'first_name': first_name,
+                                                 'last_name': last_name, 'gender': author_gender})
+        genders = []
+        for full_name in full_names:
+            first_name, last_name = split_name(full_name)
+            if not first_name:
+                genders.append('unknown')
+            else:
+                genders.append(self.__genders.get(get_name_key(first_name, last_name), ERROR_GENDER))
+        return genders
+
+    def get_gender(self, full_name):
+        return self.get_genders([full_name])[0]
+
+    def log_stats(self):
+        logging.info(f"Gender resolution: {self.stats['names']} names, {self.stats['memory_hits']} found in memory, "
+                     f"{self.stats['table_hits']} in the gender table, {self.stats['cache_hits']} in the cache, "
+                     f"{self.stats['misses']} resolved remotely "
+                     f"({self.stats['errors']} errors)")
+
+
+# Resolver shared by all the calls done in the process, configured
+# by the dictionary gender of config.json
+@functools.lru_cache(maxsize=None)
+def get_gender_resolver():
+    gender_config = get_project_config().get('gender', {})
+    gender_table = None
+    if gender_config.get('backend', 'namsor') == 'offline':
+        gender_table = load_gender_table(tuple(gender_config.get('name_files', [])))
+    return GenderResolver(gender_table=gender_table, remote_fallback=gender_config.get('remote_fallback', True))
+
+
+def get_gender(full_name):
+    return get_gender_resolver().get_gender(full_name)
+
+
+def get_genders(full_names):
+    return get_gender_resolver().get_genders(full_names)
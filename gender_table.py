@@ -0,0 +1,172 @@
+from utils import normalize_text
+
+import csv
+import functools
+import gender_guesser.detector as gender
+import json
+import logging
+import numpy as np
+import os
+import pathlib
+import pkg_resources
+import struct
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+GENDER_TABLE_FILE = pathlib.Path(__file__).parents[0].joinpath('data', 'gender_table.bin')
+
+###
+# Binary table of first names and genders. After the header come the
+# signature of the sources of the table (JSON), the names, sorted and
+# padded with zeros to the length of the longest one, and then one
+# byte per name with the code of its gender
+###
+TABLE_MAGIC = b'GNDRTBL'
+TABLE_VERSION = 2
+# Magic, version, length of the signature, length of the names, and number of names
+TABLE_HEADER = struct.Struct('<7sBIIQ')
+
+GENDER_CODES = ['unknown', 'female', 'male', 'mostly_female', 'mostly_male', 'andy']
+
+
+def normalize_first_name(first_name):
+    # Same normalization as the one used to compare author names
+    return normalize_text(first_name).lower().strip()
+
+
+def __read_name_files(name_files):
+    # Local lists of names are CSV files with the columns name and gender
+    genders = dict()
+    for name_file in name_files:
+        with open(str(name_file), 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                name_gender = row['gender'].strip().lower()
+                if name_gender not in GENDER_CODES:
+                    logging.warning(f"Unknown gender {row['gender']} of the name {row['name']} in {name_file}")
+                    continue
+                genders[normalize_first_name(row['name'])] = name_gender
+    return genders
+
+
+def __get_detector_genders():
+    detector = gender.Detector(case_sensitive=False)
+    genders = dict()
+    for name in detector.names.keys():
+        name_key = normalize_first_name(name)
+        # Names that only differ in their accents share the key, the
+        # one written without accents is kept
+        if name_key and (name_key not in genders or name_key == name):
+            genders[name_key] = detector.get_gender(name)
+    return genders
+
+
+def get_sources_signature(name_files):
+    # The table is rebuilt when gender_guesser or any of the local lists of names change
+    name_files_signature = []
+    for name_file in name_files:
+        file_stat = os.stat(str(name_file))
+        name_files_signature.append({'path': str(pathlib.Path(name_file).resolve()), 'mtime': file_stat.st_mtime,
+                                     'size': file_stat.st_size})
+    return {
+        'gender_guesser': pkg_resources.get_distribution('gender-guesser').version,
+        'name_files': name_files_signature
+    }
+
+
+def _read_header(f):
+    header = f.read(TABLE_HEADER.size)
+    if len(header) < TABLE_HEADER.size:
+        return None
+    magic, version, signature_length, name_length, num_names = TABLE_HEADER.unpack(header)
+    if magic != TABLE_MAGIC or version != TABLE_VERSION:
+        return None
+    signature = json.loads(f.read(signature_length).decode('utf-8'))
+    return {'signature': signature, 'name_length': name_length, 'num_names': num_names,
+            'offset': TABLE_HEADER.size + signature_length}
+
+
+def build_gender_table(name_files=(), file_name=GENDER_TABLE_FILE):
+    """
+    Compile the first names of gender_guesser, and those of the local lists
+    of names, into a binary table sorted by name. Local lists take precedence
+    over gender_guesser
+    :param name_files: CSV files with the columns name and gender
+    :return: number of names in the table
+    """
+    # Taken before reading the sources, so that changes made meanwhile trigger a new build
+    signature = json.dumps(get_sources_signature(name_files)).encode('utf-8')
+    genders = __get_detector_genders()
+    genders.update(__read_name_files(name_files))
+    names = np.array(sorted(name.encode('ascii') for name in genders.keys()))
+    codes = np.array([GENDER_CODES.index(genders[name.decode('ascii')]) for name in names], dtype=np.uint8)
+    table_file_name = pathlib.Path(file_name)
+    tmp_table_file_name = table_file_name.with_name(f"{table_file_name.name}.{os.getpid()}.tmp")
+    with open(str(tmp_table_file_name), 'wb') as f:
+        f.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(signature), names.dtype.itemsize, len(names)))
+        f.write(signature)
+        f.write(names.tobytes())
+        f.write(codes.tobytes())
+    # Replace the table atomically, other processes might be reading it
+    os.replace(str(tmp_table_file_name), str(table_file_name))
+    logging.info(f"Built the gender table {table_file_name.name} ({len(names)} names)")
+    return len(names)
+
+
+###
+# Read-only view of the gender table. The table is memory-mapped, so
+# opening it doesn't read it and processes share its pages
+###
+class GenderTable:
+
+    def __init__(self, file_name=GENDER_TABLE_FILE):
+        with open(str(file_name), 'rb') as f:
+            header = _read_header(f)
+        if not header:
+            raise ValueError(f"{file_name} is not a gender table of version {TABLE_VERSION}")
+        self.signature = header['signature']
+        self.name_length = header['name_length']
+        num_names = header['num_names']
+        self.names = np.memmap(str(file_name), dtype=f"S{self.name_length}", mode='r', offset=header['offset'],
+                               shape=(num_names,))
+        self.codes = np.memmap(str(file_name), dtype=np.uint8, mode='r',
+                               offset=header['offset'] + self.name_length * num_names, shape=(num_names,))
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_gender(self, first_name):
+        """
+        Find the name by binary search
+        :return: gender of the first name as returned by gender_guesser,
+        unknown if the name is not in the table
+        """
+        name_key = normalize_first_name(first_name).encode('ascii')
+        if not name_key or len(name_key) > self.name_length:
+            return 'unknown'
+        position = np.searchsorted(self.names, name_key)
+        if position < len(self.names) and self.names[position] == name_key:
+            return GENDER_CODES[self.codes[position]]
+        return 'unknown'
+
+
+def __is_table_valid(file_name, name_files):
+    if not file_name.exists():
+        return False
+    with open(str(file_name), 'rb') as f:
+        header = _read_header(f)
+    return header is not None and header['signature'] == get_sources_signature(name_files)
+
+
+@functools.lru_cache(maxsize=None)
+def load_gender_table(name_files=(), file_name=GENDER_TABLE_FILE):
+    """
+    Open the gender table, building it first if it doesn't exist or was
+    built from other sources. Tables are opened once per process
+    :param name_files: tuple with the CSV files of the local lists of names
+    """
+    file_name = pathlib.Path(file_name)
+    if not __is_table_valid(file_name, name_files):
+        build_gender_table(name_files, file_name)
+    return GenderTable(file_name)
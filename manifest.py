@@ -0,0 +1,113 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+MANIFEST_FILE = pathlib.Path(__file__).parents[0].joinpath('data', 'ingest_manifest.json')
+
+
+def compute_file_hash(file_name):
+    file_hash = hashlib.sha1()
+    with open(str(file_name), 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def compute_row_hash(row):
+    return hashlib.sha1(json.dumps(row, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+###
+# Class to keep track of the raw files, and of the rows within
+# them, that each stage of the pipeline has already processed
+###
+class IngestManifest:
+    __manifest = None
+    __file_name = None
+
+    def __init__(self, file_name=MANIFEST_FILE):
+        self.__file_name = pathlib.Path(file_name)
+        self.__file_hashes = dict()
+        if self.__file_name.exists():
+            with open(str(self.__file_name), 'r', encoding='utf-8') as f:
+                self.__manifest = json.load(f)
+        else:
+            self.__manifest = {'stages': {}}
+
+    def __get_stage(self, stage):
+        if stage not in self.__manifest['stages']:
+            self.__manifest['stages'][stage] = {'files': {}, 'rows': {}, 'last_run': None}
+        return self.__manifest['stages'][stage]
+
+    def __get_file_hash(self, file_name):
+        # Files are hashed only once per run
+        file_key = str(file_name)
+        if file_key not in self.__file_hashes:
+            self.__file_hashes[file_key] = compute_file_hash(file_name)
+        return self.__file_hashes[file_key]
+
+    def get_changes(self, stage, file_names):
+        """
+        Compare the given files with the ones that the stage processed in
+        its last run
+        :return: dictionary with the lists of new, changed, unchanged, and removed files
+        """
+        stage_files = self.__get_stage(stage)['files']
+        changes = {'new': [], 'changed': [], 'unchanged': [], 'removed': []}
+        for file_name in file_names:
+            recorded_hash = stage_files.get(str(file_name))
+            if recorded_hash is None:
+                changes['new'].append(file_name)
+            elif recorded_hash != self.__get_file_hash(file_name):
+                changes['changed'].append(file_name)
+            else:
+                changes['unchanged'].append(file_name)
+        current_files = {str(file_name) for file_name in file_names}
+        changes['removed'] = [file_name for file_name in stage_files.keys() if file_name not in current_files]
+        return changes
+
+    def get_changed_files(self, stage, file_names):
+        changes = self.get_changes(stage, file_names)
+        return changes['new'] + changes['changed']
+
+    def get_row_hashes(self, stage, file_name):
+        return dict(self.__get_stage(stage)['rows'].get(str(file_name), {}))
+
+    def is_row_changed(self, stage, file_name, row_key, row):
+        row_hashes = self.__get_stage(stage)['rows'].get(str(file_name), {})
+        return row_hashes.get(row_key) != compute_row_hash(row)
+
+    def record_row(self, stage, file_name, row_key, row):
+        self.record_row_hashes(stage, file_name, {row_key: compute_row_hash(row)})
+
+    def record_row_hashes(self, stage, file_name, row_hashes):
+        stage_rows = self.__get_stage(stage)['rows']
+        stage_rows.setdefault(str(file_name), {}).update(row_hashes)
+
+    def record_file(self, stage, file_name):
+        stage_info = self.__get_stage(stage)
+        stage_info['files'][str(file_name)] = self.__get_file_hash(file_name)
+        stage_info['last_run'] = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+
+    def forget_file(self, stage, file_name):
+        # Used when the file no longer exists
+        stage_info = self.__get_stage(stage)
+        stage_info['files'].pop(str(file_name), None)
+        stage_info['rows'].pop(str(file_name), None)
+
+    def reset_stage(self, stage):
+        self.__manifest['stages'].pop(stage, None)
+
+    def save(self):
+        tmp_file_name = self.__file_name.with_name(f"{self.__file_name.name}.{os.getpid()}.tmp")
+        with open(str(tmp_file_name), 'w', encoding='utf-8') as f:
+            json.dump(self.__manifest, f)
+        os.replace(str(tmp_file_name), str(self.__file_name))
+        logging.info(f"Saved the ingest manifest in {self.__file_name}")
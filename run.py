@@ -1,9 +1,13 @@
-from db_manager import DBManager
+from analytics_cube import build_analytics_cube
+from db_manager import DBManager, create_indexes, report_index_usage
+from db_profiler import profiler
 from data_extractor import get_paper_author_names_from_pubmed
 from data_loader import load_data_from_files_into_db
-from data_wrangler import combine_csv_files, compute_metric_papers_as_last_author, add_author_ids_to_papers
-from data_exporter import export_db_into_file, export_author_papers
-from utils import get_db_name
+from data_wrangler import combine_csv_files, compute_authors_paper_metrics, add_author_ids_to_papers, \
+                          compute_authors_bibliometrics
+from data_exporter import export_files_in_parallel, export_files_incrementally, get_author_papers_export_job, \
+    get_records_export_job
+from utils import get_db_name, get_project_config
 
 import logging
 import pathlib
@@ -13,42 +17,87 @@ logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gen
 
 
 if __name__ == '__main__':
+    # Record statistics of the database operations of each stage if enabled in config.json
+    profiling_config = get_project_config().get('profiling', {})
+    if profiling_config.get('enabled'):
+        profiler.enable(slow_operation_ms=profiling_config.get('slow_operation_ms', 200))
+
     # 1. Combine files in data/raw/full into one CSV file per journal
+    # Only new or changed files and rows are processed if loading.incremental is set in config.json
+    loading_config = get_project_config().get('loading', {})
+    incremental = loading_config.get('incremental', False)
     logging.info('Combining files...')
-    combine_csv_files()
+    combine_csv_files(incremental=incremental)
+    profiler.dump_summary('combine_csv_files')
+
+    # 2. Create the indexes of the collections (existing indexes are left untouched)
+    logging.info('Creating indexes...')
+    create_indexes(db_name=get_db_name())
+    profiler.dump_summary('create_indexes')
 
-    # 2.Load the data in data/raw/summary and data/processed into the database
+    # 3. Load the data in data/raw/summary and data/processed into the database
     logging.info('Loading data from files...')
-    load_data_from_files_into_db()
+    load_data_from_files_into_db(num_workers=loading_config.get('num_workers', 1),
+                                 shard_by=loading_config.get('shard_by', 'file'),
+                                 incremental=incremental)
+    profiler.dump_summary('load_data_from_files_into_db')
 
-    # 3. Add id of authors to papers
+    # 4. Add id of authors to papers
     logging.info('Adding to the papers an array with the id of their authors...')
-    add_author_ids_to_papers()
+    add_author_ids_to_papers(incremental=incremental)
+    profiler.dump_summary('add_author_ids_to_papers')
 
-    # 4. Get information about the papers' authors, including their full names and gender
+    # 5. Get information about the papers' authors, including their full names and gender
+    # With gender.backend set to offline in config.json, first names are looked up in data/gender_table.bin,
+    # which is built from gender_guesser and gender.name_files the first time it is needed
     logging.info('Getting full name and gender of authors...')
     get_paper_author_names_from_pubmed()
+    profiler.dump_summary('get_paper_author_names_from_pubmed')
 
-    # 5. Calculate the number of papers as last author
-    logging.info('Computing the metric papers_as_last_author...')
-    compute_metric_papers_as_last_author()
+    # 6. Calculate the number of papers, papers as first and last author, papers with citations,
+    # and total citations of authors, in the database
+    logging.info('Computing the paper metrics of authors...')
+    compute_authors_paper_metrics()
+    profiler.dump_summary('compute_authors_paper_metrics')
 
-    # 5. Export data of papers to CSV
-    logging.info('Exporting data of papers to data/papers.csv ...')
-    db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
-    fields_to_export = ['title', 'DOI', 'year', 'source', 'citations', 'edamCategory',
-                        'link', 'authors', 'gender_last_author', 'abstract']
-    export_db_into_file('papers.csv', db_papers, fields_to_export)
+    # 7. Compute the bibliometric indicators of authors (h-index, g-index, i10-index, mean and median citations)
+    logging.info('Computing the bibliometrics of authors...')
+    compute_authors_bibliometrics()
+    profiler.dump_summary('compute_authors_bibliometrics')
 
-    # 6. Export data of authors to CSV
-    # logging.info('Exporting data of authors to data/authors.csv ...')
+    # 8. Materialize the analytics cube (year x journal x EDAM category x author position x gender)
+    logging.info('Building the analytics cube...')
+    build_analytics_cube()
+    profiler.dump_summary('build_analytics_cube')
+
+    # 9. Export data of papers, authors, and authorships (papers x authors). The three exports
+    # run at the same time, split into ranges of records exported by a pool of processes. In
+    # incremental mode, only the records changed since the last export are exported
+    exporting_config = get_project_config().get('exporting', {})
+    author_papers_format = exporting_config.get('author_papers_format', 'csv')
+    logging.info(f"Exporting data to data/papers.csv, data/authors.csv, and "
+                 f"data/papers_authors.{author_papers_format} ...")
+    db_papers = DBManager('bioinfo_papers', db_name=get_db_name())
+    papers_fields = ['title', 'DOI', 'year', 'source', 'citations', 'edamCategory',
+                     'link', 'authors', 'gender_last_author', 'abstract']
     db_authors = DBManager('bioinfo_authors', db_name=get_db_name())
-    fields_to_export = ['name', 'gender', 'papers', 'total_citations', 'papers_as_first_author',
-                        'papers_as_last_author', 'papers_with_citations']
-    export_db_into_file('authors.csv', db_authors, fields_to_export)
+    authors_fields = ['name', 'gender', 'papers', 'total_citations', 'papers_as_first_author',
+                      'papers_as_last_author', 'papers_with_citations']
+    export_jobs = [
+        get_records_export_job('papers.csv', db_papers, papers_fields),
+        get_records_export_job('authors.csv', db_authors, authors_fields),
+        get_author_papers_export_job(f"papers_authors.{author_papers_format}", file_format=author_papers_format,
+                                     partition_by_year=exporting_config.get('partition_by_year', False))
+    ]
+    if exporting_config.get('incremental', False):
+        export_files_incrementally(export_jobs, num_workers=exporting_config.get('num_workers', 1),
+                                   max_deltas=exporting_config.get('max_deltas', 7))
+    else:
+        export_files_in_parallel(export_jobs, num_workers=exporting_config.get('num_workers', 1))
+    profiler.dump_summary('export_files')
 
-    # 7. Export data of authors and papers to CSV
-    logging.info('Exporting data of papers and authors to data/papers_authors.csv ...')
-    export_author_papers('papers_authors.csv')
+    # 10. Report the usage of the indexes and warn about missing ones
+    report_index_usage(db_name=get_db_name())
 
-    logging.info('The files data/papers.csv, data/authors.csv, and data/papers_authors.csv were created')
\ No newline at end of file
+    logging.info(f"The files data/papers.csv, data/authors.csv, and data/papers_authors.{author_papers_format} "
+                 f"were created")
\ No newline at end of file
@@ -0,0 +1,155 @@
+import codecs
+import csv
+import io
+import logging
+import pathlib
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+logging.basicConfig(filename=str(pathlib.Path(__file__).parents[0].joinpath('gender_identification.log')),
+                    level=logging.DEBUG)
+
+
+# Columns with several values separated by semicolons. They are
+# also returned already split in list columns with the given names
+LIST_COLUMNS = {
+    'Author(s) ID': 'author_ids',
+    'Authors with affiliations': 'authors_with_affiliations'
+}
+
+CANDIDATE_ENCODINGS = ['utf-8-sig', 'ISO-8859-1']
+
+# Size of the blocks in which files are decoded and parsed
+BLOCK_SIZE = 1 << 20
+
+
+def detect_encoding(file_name):
+    # Only the first block is decoded, UTF-8 files are validated
+    # by Arrow as they are parsed (see read_scopus_file)
+    with open(str(file_name), 'rb') as f:
+        sample = f.read(BLOCK_SIZE)
+    for encoding in CANDIDATE_ENCODINGS:
+        try:
+            # Not final, the block might end in the middle of a character
+            codecs.getincrementaldecoder(encoding)().decode(sample)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"Could not detect the encoding, tried {CANDIDATE_ENCODINGS}")
+
+
+###
+# Binary stream that converts a file in any encoding to UTF-8 as it
+# is read, since the parser of Arrow only accepts UTF-8
+###
+class Utf8Recoder(io.RawIOBase):
+
+    def __init__(self, f, encoding):
+        self.__reader = codecs.getreader(encoding)(f)
+        self.__pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.__pending) < len(buffer):
+            text = self.__reader.read(BLOCK_SIZE)
+            if not text:
+                break
+            self.__pending += text.encode('utf-8')
+        num_bytes = min(len(buffer), len(self.__pending))
+        buffer[:num_bytes] = self.__pending[:num_bytes]
+        self.__pending = self.__pending[num_bytes:]
+        return num_bytes
+
+
+def __split_list_column(column):
+    values = [[item.strip() for item in value.split(';')] for value in column.to_pylist()]
+    return pa.array(values, type=pa.list_(pa.string()))
+
+
+def __add_list_columns(batch):
+    arrays, names = batch.columns, batch.schema.names
+    for column_name, list_column_name in LIST_COLUMNS.items():
+        if column_name in batch.schema.names:
+            arrays = arrays + [__split_list_column(batch.column(batch.schema.get_field_index(column_name)))]
+            names = names + [list_column_name]
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def __is_utf8(encoding):
+    return codecs.lookup(encoding).name in ('utf-8', 'utf-8-sig')
+
+
+def __read_batches(file_name, encoding, read_options, parse_options, convert_options):
+    if __is_utf8(encoding):
+        # UTF-8 files are read and parsed by Arrow without going through Python
+        reader = pa_csv.open_csv(str(file_name), read_options=read_options, parse_options=parse_options,
+                                 convert_options=convert_options)
+        yield from reader
+        return
+    with open(str(file_name), 'rb') as f:
+        reader = pa_csv.open_csv(Utf8Recoder(f, encoding), read_options=read_options, parse_options=parse_options,
+                                 convert_options=convert_options)
+        yield from reader
+
+
+def read_scopus_file(file_name, columns=None, batch_size=5000):
+    """
+    Read a Scopus export (summary or full) with the multi-threaded CSV reader
+    of Arrow, block by block, so that only a block of the file is held in
+    memory at a time. All the columns are read as strings. Files that are not
+    UTF-8 are converted to UTF-8 as they are read.
+    :param columns: columns to read, all if None
+    :return: generator of record batches of at most batch_size rows
+    """
+    encoding = detect_encoding(file_name)
+    # Only the first row is read to get the columns of the file
+    with open(str(file_name), 'r', encoding=encoding, newline='') as f:
+        header = next(csv.reader(f))
+    logging.info(f"Reading {pathlib.Path(file_name).name} (encoding: {encoding})")
+    # The header, and the BOM before it, are skipped since the columns are already known
+    read_options = pa_csv.ReadOptions(use_threads=True, block_size=BLOCK_SIZE, column_names=header, skip_rows=1)
+    parse_options = pa_csv.ParseOptions(delimiter=',', newlines_in_values=True)
+    columns_to_read = [column for column in header if not columns or column in columns]
+    convert_options = pa_csv.ConvertOptions(column_types={column: pa.string() for column in header},
+                                            include_columns=columns_to_read)
+    num_rows = 0
+    try:
+        for batch in __read_batches(file_name, encoding, read_options, parse_options, convert_options):
+            batch = __add_list_columns(batch)
+            for offset in range(0, batch.num_rows, batch_size):
+                yield batch.slice(offset, batch_size)
+            num_rows += batch.num_rows
+    except pa.ArrowInvalid as e:
+        if not __is_utf8(encoding) or 'UTF8' not in str(e):
+            raise
+        # The first block was valid UTF-8 but a later one isn't, the file is read
+        # again as ISO-8859-1 and the rows already returned are skipped
+        logging.warning(f"{pathlib.Path(file_name).name} is not UTF-8, reading it again as ISO-8859-1")
+        for batch in __read_batches(file_name, 'ISO-8859-1', read_options, parse_options, convert_options):
+            if num_rows >= batch.num_rows:
+                num_rows -= batch.num_rows
+                continue
+            batch = __add_list_columns(batch.slice(num_rows))
+            num_rows = 0
+            for offset in range(0, batch.num_rows, batch_size):
+                yield batch.slice(offset, batch_size)
+
+
+def iter_batch_rows(batch):
+    """
+    :return: generator of the rows of a record batch as dictionaries
+    """
+    batch_dict = batch.to_pydict()
+    column_names = list(batch_dict.keys())
+    for row_values in zip(*batch_dict.values()):
+        yield dict(zip(column_names, row_values))
+
+
+def iter_scopus_records(file_name, columns=None, batch_size=5000):
+    """
+    Read a Scopus export and return its rows as dictionaries
+    """
+    for batch in read_scopus_file(file_name, columns, batch_size):
+        yield from iter_batch_rows(batch)
@@ -1,8 +1,7 @@
-from hammock import Hammock as GendreAPI
+from eid_index import find_paper_by_eid, parse_pubmed_id
 from similarity.jarowinkler import JaroWinkler
 
-import csv
-import gender_guesser.detector as gender
+import functools
 import logging
 import json
 import re
@@ -21,6 +20,15 @@ def get_config(config_file):
     return config
 
 
+# Get the configuration of the project (config.json) reading
+# the file only once per process
+@functools.lru_cache(maxsize=None)
+def get_project_config():
+    current_dir = pathlib.Path(__file__).parents[0]
+    config_fn = current_dir.joinpath('config.json')
+    return get_config(config_fn)
+
+
 def curate_author_name(author_raw):
     regex = re.compile('[0-9*]')
     author_clean = regex.sub('', author_raw).replace(' and ', ' ').replace('.', '').replace('-', ' ').rstrip(',')\
@@ -54,29 +62,6 @@ def load_countries_file():
     return countries
 
 
-def get_gender(full_name):
-    gendre_api = GendreAPI("http://api.namsor.com/onomastics/api/json/gendre")
-    gendre_api2 = gender.Detector(case_sensitive=False)
-
-    first_name = full_name.split()[0]
-    last_name = full_name.split()[-1]
-    resp = gendre_api(first_name, last_name).GET()
-    try:
-        author_gender = resp.json().get('gender')
-        if author_gender == 'unknown':
-            logging.info('Trying to get the author\'s gender using the second api')
-            # if the main api returns unknown gender, try with another api
-            author_gender = gendre_api2.get_gender(first_name)
-            author_gender = 'unknown' if author_gender == 'andy' else author_gender
-        if author_gender == 'mostly_male':
-            author_gender = 'male'
-        if author_gender == 'mostly_female':
-            author_gender = 'female'
-        return author_gender
-    except:
-        return 'error_api'
-
-
 def get_base_url(full_url):
     base_url = ''
     slash_counter = 0
@@ -99,9 +84,7 @@ def title_except(str_to_title, exceptions=('a', 'an', 'of', 'the')):
 
 
 def get_db_name():
-    current_dir = pathlib.Path(__file__).parents[0]
-    config_fn = current_dir.joinpath('config.json')
-    config = get_config(config_fn)
+    config = get_project_config()
     return config['mongo']['db_name']
 
 
@@ -110,17 +93,9 @@ def normalize_text(text):
 
 
 def obtain_paper_abstract_and_pubmedid(file_name, paper_eid):
-    dir_full = pathlib.Path('data', 'processed')
-    journal_file_name = dir_full.joinpath(file_name)
-    with open(str(journal_file_name), 'r') as f:
-        file = csv.DictReader(f, delimiter=',')
-        for line in file:
-            if line['EID'] == paper_eid:
-                if '.0' in line['PubMed ID']:
-                    pubmed_id = line['PubMed ID'].split('.')[0]
-                else:
-                    pubmed_id = line['PubMed ID']
-                return line['Abstract'], pubmed_id, line
+    line = find_paper_by_eid(file_name, paper_eid)
+    if line:
+        return line['Abstract'], parse_pubmed_id(line['PubMed ID']), line
     return None, None, None
 
 